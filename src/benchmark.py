@@ -0,0 +1,147 @@
+'''
+benchmark of the pipelines on synthetic data (synthetic.py)
+
+ main() of each pipeline runs in its own process with the synthetic data in ROOT/data and
+ LMCP_PROFILE=1, its stages are timed by instrument.py (wall and cpu seconds, RSS after the
+ stage); throughput is rows of input per second of the pipeline
+
+ python benchmark.py --households 2000 --meters 5000 --out bench.json
+ python benchmark.py --households 2000 --meters 5000 --baseline bench.json  (exit 1 if a stage got slower)
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import shutil
+import tempfile
+import subprocess
+from pathlib import Path
+
+import synthetic
+import instrument
+
+src = Path(__file__).resolve().parent
+
+# pipeline -> (module, synthetic file whose rows are the input), in the order they run
+# cons_data_analysis reads the output of cons_data_processing
+PIPELINES = {
+    'cons_data_processing': ('cons_data_processing', 'consumption'),
+    'cons_data_analysis': ('cons_data_analysis', 'consumption'),
+    'merge': ('merge', 'post_pre_paid'),
+    'prepost_figures': ('prepost_figures', 'post_pre_paid'),
+}
+
+########################
+# FUNCTIONS
+#######################
+
+def peak_rss():
+    '''
+    peak resident set size in MB of this process or of the largest of its finished worker processes
+    (merge, histograms), whichever is larger; ru_maxrss is in KB on linux, bytes on mac; nan on windows
+    '''
+    # resource is unix only
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    rss = max(resource.getrusage(who).ru_maxrss for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN])
+    return rss/2**20 if sys.platform == 'darwin' else rss/2**10
+
+def run_stages(module, report):
+    '''
+    run main() of module and write the timings of its stages (see instrument.py) to the json file report
+    stages inside other stages are left out, 'import' is the time to import the module
+    (runs in the process started by run_pipeline, with LMCP_PROFILE set)
+    '''
+    wall, cpu = time.perf_counter(), time.process_time()
+    module = importlib.import_module(module)
+    timings = [{'stage': 'import', 'seconds': time.perf_counter() - wall, 'cpu_seconds': time.process_time() - cpu, 'rss_mb': instrument.rss()}]
+    module.main([])
+    timings.extend({k: s[k] for k in ['stage', 'seconds', 'cpu_seconds', 'rss_mb']} for s in instrument.stages if s['depth'] == 0)
+    Path(report).write_text(json.dumps({'stages': timings, 'peak_rss_mb': peak_rss()}))
+
+def run_pipeline(pipeline, root, rows, warm = False):
+    '''
+    run main() of the module of pipeline in a new process with the data in root/data, its output goes to root/{pipeline}.log
+    warm: keep data/cache (parsed files, normalized frames, stored matches) of earlier runs
+    returns the timings of its stages, total seconds, rows of input per second and peak RSS
+    '''
+    module, input = PIPELINES[pipeline]
+    if not warm:
+        shutil.rmtree(root/'data'/'cache', ignore_errors=True)
+    # the scripts read wd.parent/'data' with wd the working directory
+    (root/'src').mkdir(exist_ok=True)
+    report = root/f'{pipeline}.json'
+    env = dict(os.environ, MPLBACKEND='Agg', LMCP_PROFILE='1', PYTHONPATH=os.pathsep.join([str(src), os.environ.get('PYTHONPATH', '')]))
+    with open(root/f'{pipeline}.log', 'w') as log:
+        subprocess.run([sys.executable, str(Path(__file__).resolve()), '--run-stages', module, '--report', str(report)], cwd=root/'src', env=env, stdout=log, stderr=subprocess.STDOUT, check=True)
+    result = json.loads(report.read_text())
+    total = sum(t['seconds'] for t in result['stages'])
+    return {'stages': result['stages'], 'seconds': total, 'rows': rows[input], 'rows_per_second': rows[input]/total, 'peak_rss_mb': result['peak_rss_mb']}
+
+def compare(results, baseline, tolerance = 1.25, min_seconds = 0.1):
+    '''
+    print the ratio of the seconds to the baseline per stage
+    returns the stages that are more than tolerance times and min_seconds slower (short stages are noise)
+    '''
+    slower = []
+    for pipeline, result in results.items():
+        old = {t['stage']: t['seconds'] for t in baseline.get(pipeline, {}).get('stages', [])}
+        for t in result['stages']:
+            if t['stage'] in old and old[t['stage']] > 0:
+                ratio = t['seconds']/old[t['stage']]
+                is_slower = (ratio > tolerance) & (t['seconds'] - old[t['stage']] > min_seconds)
+                print(f'{pipeline:22} {t["stage"][:40]:40} {old[t["stage"]]:8.2f}s -> {t["seconds"]:8.2f}s  x{ratio:.2f}{" <- slower" if is_slower else ""}')
+                if is_slower:
+                    slower.append((pipeline, t['stage']))
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description='time the pipelines on synthetic data')
+    parser.add_argument('--root', help='folder for the synthetic data and outputs, a temporary folder by default')
+    parser.add_argument('--households', type=int, default=2000)
+    parser.add_argument('--transformers', type=int, default=50)
+    parser.add_argument('--meters', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pipelines', nargs='+', choices=list(PIPELINES), default=list(PIPELINES))
+    parser.add_argument('--warm', action='store_true', help='keep data/cache between the pipelines (default: every pipeline starts cold)')
+    parser.add_argument('--out', help='write the results to this json file')
+    parser.add_argument('--baseline', help='json file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='stages slower than tolerance x baseline are reported')
+    parser.add_argument('--run-stages', help=argparse.SUPPRESS)
+    parser.add_argument('--report', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stages:
+        run_stages(args.run_stages, args.report)
+        return
+
+    root = Path(args.root) if args.root else Path(tempfile.mkdtemp(prefix='lmcp_bench_'))
+    t = time.perf_counter()
+    rows = synthetic.write_data(root, households=args.households, transformers=args.transformers, meters=args.meters, seed=args.seed)
+    print(f'synthetic data in {root}: {rows} ({time.perf_counter() - t:.1f}s)')
+
+    results = {}
+    for pipeline in [p for p in PIPELINES if p in args.pipelines]:
+        result = run_pipeline(pipeline, root, rows, args.warm)
+        results[pipeline] = result
+        print(f'\n{pipeline}: {result["seconds"]:.2f}s, {result["rows_per_second"]:,.0f} rows/s, peak RSS {result["peak_rss_mb"]:.0f} MB')
+        for s in result['stages']:
+            print(f'  {s["stage"][:40]:40} {s["seconds"]:8.2f}s  cpu {s["cpu_seconds"]:8.2f}s  rss {s["rss_mb"]:6.0f} MB')
+
+    results = {'parameters': {'households': args.households, 'transformers': args.transformers, 'meters': args.meters, 'seed': args.seed, 'warm': args.warm, 'rows': rows}, **results}
+    if args.out:
+        Path(args.out).write_text(json.dumps(results, indent=2))
+    if args.baseline:
+        print()
+        slower = compare({p: r for p, r in results.items() if p in PIPELINES}, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
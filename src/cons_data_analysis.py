@@ -1,35 +1,60 @@
 '''
 summary statistics, histograms, etc
-Input: 
+Input: data/cons_data_all.zip (cons_data_processing.py)
+
+ python cons_data_analysis.py [--data ../data] [--figures ../figures] [--period 90] [--no-figures] [--engine duckdb|store]
+ or from python: cons_data_analysis.run(data, figures)
 '''
 
-from datetime import timedelta
-import zipfile
+import os
+import argparse
 import numpy as np
-import pandas as pd
 from pathlib import Path
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator, PercentFormatter
 from datetime import timedelta
-from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor
+from pools import mp_context
+from loader import read_member
+from schema import CONSUMPTION
+from instrument import stage, timed, write_report
+from transactions import collapse
+from sketches import Histogram
 
 
 wd = Path.cwd()
 folder = 'data'
 
-# load data
-zip = ZipFile(wd.parent/folder/'cons_data_all.zip')
-df = pd.read_csv(zip.open('cons_data_all.csv'), parse_dates=['vending_date', 'meterinstdate'], dtype={'meternumber':str, 'zrefrence':str})
+# 3-month period
+period = 90
+# further panels, e.g. [30, 365], exported as cons_data_pmeter_panel_{days}
+other_periods = []
+# processes rendering the histograms of the counties
+workers = os.cpu_count()
+
+########################
+# FUNCTIONS
+#######################
+
+def load(data):
+    '''
+    combined consumption data in the folder data
+    '''
+    with stage('load') as st:
+        df = read_member(data/'cons_data_all.zip', 'cons_data_all.csv', schema = CONSUMPTION, parse_dates=['vending_date', 'meterinstdate'], dtype={'meternumber':str, 'zrefrence':str})
+        st.rows_out = len(df)
+    return df
 
 
 #*#########################
 #! CHECK DATA
 #*#########################
 
-df.describe()
-nmis = df.shape[0] - df.amount.count() # 1705 rows have missing values for amount, etc.
-# all missings come from kilifi
-df.loc[df.amount.isnull() & (df.county == 'KILIFI'),].shape[0] == nmis
+def check_data(df):
+    '''
+    True if all missing amounts come from kilifi
+    '''
+    nmis = df.shape[0] - df.amount.count() # 1705 rows have missing values for amount, etc.
+    # all missings come from kilifi
+    return df.loc[df.amount.isnull() & (df.county == 'KILIFI'),].shape[0] == nmis
 
 
 #*#########################
@@ -39,83 +64,110 @@ df.loc[df.amount.isnull() & (df.county == 'KILIFI'),].shape[0] == nmis
 # 15512 names Xx
 # df.loc[df.name == 'Xx',]
 
-# add rows if same meternumber and vending_date
-collapse = df.groupby(['meternumber', 'vending_date'])[['amount', 'units', 'debt_collected']].sum()
-collapse.reset_index(inplace = True)
-
-# drop columns amount units and debt, add the collapse data and drop duplicates
-df = df.drop(columns = ['amount', 'units', 'debt_collected'])
-df = df.merge(collapse, on = ['meternumber', 'vending_date'], how='left').drop_duplicates(['meternumber', 'vending_date'])
-
-# sort df by meternumber and vending date
-df = df.sort_values(by = ['meternumber', 'vending_date'])
-
-# time elapsed between purchases 
-df['time_elapsed'] = df['vending_date'].diff() 
-df.loc[(df.meternumber != df.meternumber.shift(1)) ,'time_elapsed'] = np.nan
-
-# get net amount
-df['amount_net'] = df.amount - df.debt_collected
+def prepare(df):
+    '''
+    one row per meter and vending date, time elapsed between purchases, net amount and year
+    '''
+    with stage('collapse', rows_in = len(df)) as st:
+        # add rows if same meternumber and vending_date, sorted by meternumber and vending date
+        df = collapse(df, ['meternumber', 'vending_date'], ['amount', 'units', 'debt_collected'])
 
-# get year
-df['year'] = df.vending_date.dt.year
+        # time elapsed between purchases
+        df['time_elapsed'] = df['vending_date'].diff()
+        df.loc[(df.meternumber != df.meternumber.shift(1)) ,'time_elapsed'] = np.nan
 
-# first vending date per customer
-first_vend = df.groupby(['meternumber'])['vending_date'].min()
-first_vend = first_vend.rename('first_vending_date')
-df = df.merge(first_vend, left_on=['meternumber'], right_index=True, how = 'left')
+        # get net amount
+        df['amount_net'] = df.amount - df.debt_collected
 
-# last vending date
-last_vend = df.groupby(['meternumber'])['vending_date'].max()
-last_vend = last_vend.rename('last_vending_date')
-df = df.merge(last_vend, left_on=['meternumber'], right_index=True, how = 'left')
+        # get year
+        df['year'] = df.vending_date.dt.year
+        st.rows_out = len(df)
+    return df
 
-# keep one row for each meter 
-df_cust = df.drop_duplicates(['meternumber']).reset_index(drop=True)
-df_cust = df_cust.drop(columns=['vending_date', 'amount', 'units', 'debt_collected', 'time_elapsed', 'amount_net', 'year'])
+def per_meter(df):
+    '''
+    one row per meter (df_cust): first and last vending date, number of purchases, gap to meterinstdate
+    adds purchases per year and days since the first purchase to df
+    returns df, df_cust
+    '''
+    with stage('per meter', rows_in = len(df)) as st:
+        # per meter: first and last vending date, number of purchases
+        meter_agg = df.groupby('meternumber', observed = True).agg(first_vending_date = ('vending_date', 'min'), last_vending_date = ('vending_date', 'max'), no_purchase = ('vending_date', 'size'))
 
-# year of first purchase
-df_cust['year'] = df_cust.first_vending_date.dt.year
+        # first vending date per row
+        df['first_vending_date'] = df['meternumber'].map(meter_agg['first_vending_date'])
 
+        # keep one row for each meter
+        df_cust = df.drop_duplicates(['meternumber']).reset_index(drop=True)
+        df_cust = df_cust.drop(columns=['vending_date', 'amount', 'units', 'debt_collected', 'time_elapsed', 'amount_net', 'year'])
+        df_cust['last_vending_date'] = df_cust['meternumber'].map(meter_agg['last_vending_date'])
 
-# number of purchases per meter % per year / 6 months
-no_purchase = df.meternumber.value_counts()
-no_purchase = no_purchase.rename('no_purchase')
+        # year of first purchase
+        df_cust['year'] = df_cust.first_vending_date.dt.year
 
-df_cust = df_cust.merge(no_purchase, left_on='meternumber', right_index=True, how = 'left')
-df_cust = df_cust.reset_index(drop=True)
+        # number of purchases per meter % per year / 6 months
+        df_cust['no_purchase'] = df_cust['meternumber'].map(meter_agg['no_purchase'])
 
-# no of purchases per year
-no_purch_year = df.value_counts(subset = ['meternumber', 'year']).rename('no_purch_year')
-df = df.merge(no_purch_year, how = 'left', left_on=['meternumber', 'year'], right_index=True)
+        # no of purchases per year
+        df['no_purch_year'] = df.groupby(['meternumber', 'year'], observed = True)['vending_date'].transform('size')
 
-# gap between first purchase and meterinstdate
-df_cust['gap'] = df_cust.first_vending_date - df_cust.meterinstdate
+        # gap between first purchase and meterinstdate
+        df_cust['gap'] = df_cust.first_vending_date - df_cust.meterinstdate
 
-# make time series: check periods between vending date and first vending date
-df['days_since_inst'] = df.vending_date - df.first_vending_date # days from first to vending
+        # make time series: check periods between vending date and first vending date
+        df['days_since_inst'] = df.vending_date - df.first_vending_date # days from first to vending
+        st.rows_out = len(df_cust)
+    return df, df_cust
 
 
 # make panel
-period = 90 # 3-month period
-max_p = (df.days_since_inst.max()/period).days # maximum number of periods
-# create new column
-df['period_since_inst'] = np.nan
-# loop over periods
-for p in range(1,max_p+1):
-    # assign periods
-    bool = (df.days_since_inst >= timedelta(days = (p-1)*period)) & (df.days_since_inst < timedelta(days = p*period))
-    df.loc[bool,'period_since_inst'] = p
 
-# created aggregated variables
-amount_pp = df.groupby(['meternumber', 'period_since_inst'])[['amount', 'amount_net', 'units']].sum()
-amount_pp.reset_index(inplace = True)
-
-df_cust_panel = df_cust.merge(amount_pp, on=['meternumber'])
-
-
-# export df of customers
-df_cust_panel.to_csv(wd.parent/'data'/'cons_data_pmeter_panel.zip', index=False, compression={'method': 'zip', 'archive_name': 'cons_data_pmeter_panel.csv'})
+def period_since(days, period):
+    '''
+    period (1, 2, ...) of length period days in which days falls
+    the last, incomplete period is missing as the periods go up to the maximum number of complete periods
+    '''
+    max_p = (days.max()/period).days # maximum number of periods
+    p = days // timedelta(days = period) + 1
+    return p.where(p <= max_p)
+
+@timed()
+def make_panel(df, df_cust, col):
+    '''
+    amount and units per meter and period in col, merged with df_cust
+    '''
+    # created aggregated variables
+    amount_pp = df.groupby(['meternumber', col], observed = True)[['amount', 'amount_net', 'units']].sum()
+    amount_pp.reset_index(inplace = True)
+    return df_cust.merge(amount_pp, on=['meternumber'])
+
+def write_panel(panel, data, name):
+    '''
+    export a panel to data/{name}.zip
+    '''
+    panel.to_csv(data/f'{name}.zip', index=False, compression={'method': 'zip', 'archive_name': f'{name}.csv'})
+
+def panels(df, df_cust, data, period = 90, other_periods = []):
+    '''
+    panel of meters and periods of period days since the first purchase, exported to data/cons_data_pmeter_panel.zip
+    and one panel for each of other_periods
+    returns the panel of period
+    '''
+    with stage('panel', rows_in = len(df)) as st:
+        df['period_since_inst'] = period_since(df.days_since_inst, period)
+
+        df_cust_panel = make_panel(df, df_cust, 'period_since_inst')
+
+
+        # export df of customers
+        write_panel(df_cust_panel, data, 'cons_data_pmeter_panel')
+
+        for p in other_periods:
+            df[f'period_since_inst_{p}'] = period_since(df.days_since_inst, p)
+            panel = make_panel(df, df_cust, f'period_since_inst_{p}')
+            write_panel(panel, data, f'cons_data_pmeter_panel_{p}')
+        st.rows_out = len(df_cust_panel)
+    return df_cust_panel
 
 
 #*#########################
@@ -125,51 +177,114 @@ df_cust_panel.to_csv(wd.parent/'data'/'cons_data_pmeter_panel.zip', index=False,
 # @DANA: if you want to check entries with a negative gap (first vending is before meterinstdate) - 9253 entries
 # df_cust.loc[df_cust.gap < timedelta(days = 0),]
 
-# unique counties
-county = df.county.unique()
-for c in county:
+def bins_of(h, binwidth):
+    '''
+    bins of width binwidth from the minimum to the maximum of the values in the histogram h
+    '''
+    return range(int(h.min), int(h.max) + binwidth , binwidth)
+
+def histogram_counts(df):
+    '''
+    number of rows per county and value of no_purch_year and of the days between purchases
+    '''
+    purch = df.groupby(['county', 'no_purch_year'], observed = True).size()
+    elapsed = df.groupby([df['county'], df['time_elapsed'].dt.days.rename('days_elapsed')], observed = True).size()
+    return [purch, elapsed]
+
+def county_sketches(df_cust, counts):
+    '''
+    value counts (sketches.Histogram with bins of width 1) of the histograms of each county, the data is grouped by county once
+    counts: rows per county and value of no_purch_year and days between purchases (histogram_counts)
+    returns {county: [meterinstdate, gap, no_purch_year, time_elapsed]}
+    '''
+    time = 'D' # D: days, M: months
+    purch, elapsed = [{c: s.droplevel(0) for c, s in n.groupby(level = 0, sort = False)} for n in counts]
+    sketches = {}
+    for c, d in df_cust.groupby('county', observed = True, sort = False):
+        # year of installation, gap in days, number of purchases and time elapsed weighted by their number of rows
+        n, e = purch[c], elapsed[c]
+        sketches[c] = [Histogram().update(d['meterinstdate'].dt.year), Histogram().update(d['gap'].astype(f'timedelta64[{time}]')),
+                       Histogram().update(n.index, n.values), Histogram().update(e.index, e.values)]
+    return sketches
+
+def county_histograms(sketches):
+    '''
+    density histograms (values, bin edges) of np.histogram for the figure of each county
+    sketches: value counts of each county (county_sketches or cons_store.summaries), the bins are
+     edges of the counts so the histograms are the same as np.histogram of the data
+    returns {county: [meterinstdate, gap, no_purch_year, time_elapsed]}
+    '''
+    hists = {}
+    for c, (inst, gap, n, e) in sketches.items():
+        # meterinstdate with the default bins of plt.hist, gap in bins of 30 days, the others of 5
+        hists[c] = [inst.histogram(bins = 10, density = True),
+                    gap.histogram(bins = bins_of(gap, 30), density = True),
+                    n.histogram(bins = bins_of(n, 5), density = True),
+                    e.histogram(bins = bins_of(e, 5), density = True)]
+    return hists
+
+def use_agg():
+    '''
+    non-interactive Agg backend, initializer of the processes of histograms()
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+
+def render_histograms(c, hists, figures):
+    '''
+    figure of the histograms of county c, saved as figures/histograms_{c}.png
+    run in the processes of histograms() or in the main process with its backend
+    '''
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import MaxNLocator
 
     fig,ax=plt.subplots(2,2, figsize = (10,5))
     fig.suptitle(c)
+    # the values are densities already, each bin is drawn with its value as weight
+    for a, (values, edges) in zip(ax.flat, hists):
+        a.hist(edges[:-1], bins = edges, weights = values)
+        a.tick_params(axis="x")
 
     # meterinstdate
-    input = df_cust.loc[df_cust.county == c,'meterinstdate'].dt.year
-    ax[0,0].hist(input, density = True)
     ax[0,0].set_xticks([2016, 2017, 2018, 2019, 2020, 2021])
-    ax[0,0].tick_params(axis="x")
     ax[0,0].set_title('date of installation')
 
     # gap
-    time = 'D' # D: days, M: months
-    input = df_cust.loc[df_cust.county == c,'gap'].astype(f'timedelta64[{time}]')
-    binwidth = 30
-    ax[0,1].hist(input, bins=range(int(input.min()), int(input.max()) + binwidth , binwidth), density = True)
-    ax[0,1].xaxis.set_major_locator(MaxNLocator(7)) 
-    ax[0,1].tick_params(axis="x")
+    time = 'D'
+    ax[0,1].xaxis.set_major_locator(MaxNLocator(7))
     ax[0,1].set_title(f'time between installation and first purchase in {time}')
     #ax[0,1].set_xlim(0) # if you only want to see only positive values
 
     # number of purchases % make percent on yaxis
-    input = df.loc[df.county == c,'no_purch_year']
-    binwidth = 5
-    ax[1,0].hist(input, bins=range(int(input.min()), int(input.max()) + binwidth , binwidth), density = True)
-    ax[1,0].xaxis.set_major_locator(MaxNLocator(7)) 
-    ax[1,0].tick_params(axis="x")
+    ax[1,0].xaxis.set_major_locator(MaxNLocator(7))
     ax[1,0].set_title('# purchases in a year')
 
     # time elapsed
-    input = df.loc[df.county == c,'time_elapsed'].dt.days
-    binwidth = 5
-    ax[1,1].hist(input, bins=range(int(input.min()), int(input.max()) + binwidth , binwidth), density = True)
-    ax[1,1].xaxis.set_major_locator(MaxNLocator(7)) 
-    ax[1,1].tick_params(axis="x")
+    ax[1,1].xaxis.set_major_locator(MaxNLocator(7))
     ax[1,1].set_title('days between vendings')
     ax[1,1].set_xlim(1,250)
-    
+
     plt.tight_layout()
 
-    fig.savefig(wd.parent/f'figures/histograms_{c}.png')
-    plt.close()
+    fig.savefig(figures/f'histograms_{c}.png')
+    plt.close(fig)
+
+def histograms(sketches, figures, workers = 1):
+    '''
+    histograms of installation date, gap, purchases per year and days between vendings for each county
+    saved as figures/histograms_{county}.png
+    sketches: value counts of each county (county_sketches or cons_store.summaries)
+    workers: number of processes rendering the figures, they get the bins of np.histogram instead of the data
+    '''
+    with stage('histograms'):
+        hists = county_histograms(sketches)
+        if workers > 1:
+            with ProcessPoolExecutor(workers, mp_context = mp_context(), initializer = use_agg) as ex:
+                list(ex.map(render_histograms, hists, hists.values(), [figures]*len(hists)))
+        else:
+            for c, h in hists.items():
+                render_histograms(c, h, figures)
+
 
 #*#########################
 #! TIME SERIES
@@ -192,43 +307,118 @@ plt.title('units per period since meterinstdate - period = 90 days')
 plt.savefig(wd.parent/'figures'/'amount_net_scatter.png')
 plt.close()
 '''
-  
-# line plot # take median of all customer-period level pairs
-periods = df_cust_panel.groupby(['period_since_inst', 'year'])[['amount', 'amount_net', 'units']].median()
-periods.reset_index(inplace=True)
-
-# units
-fig, ax = plt.subplots()
-for y in periods.year.unique():
-    input = periods.loc[periods.year == y,]
-    ax.plot(input.period_since_inst, input.units, label = f'{int(y)}')
-    ax.set_title('median of units')
-    ax.set_xlabel(f'periods since first purchase (period  = {period} days)')
-    ax.legend()
-
-#fig.savefig(wd.parent/'figures'/'units_year.png')
-#plt.close()
-
-# amount
-fig, ax = plt.subplots()
-for y in periods.year.unique():
-    input = periods.loc[periods.year == y,]
-    ax.plot(input.period_since_inst, input.amount, label = f'{int(y)}')
-    ax.set_title('median of amount')
-    ax.set_xlabel(f'periods since first purchase (period  = {period} days)')
-    ax.legend()
-
-#fig.savefig(wd.parent/'figures'/'amount_year.png')
-#plt.close()
-
-# amount net
-fig, ax = plt.subplots()
-for y in periods.year.unique():
-    input = periods.loc[periods.year == y,]
-    ax.plot(input.period_since_inst, input.amount_net, label = f'{int(y)}')
-    ax.set_title('median of net amount')
-    ax.set_xlabel(f'periods since first purchase (period  = {period} days)')
-    ax.legend()
-
-#fig.savefig(wd.parent/'figures'/'amount_net_year.png')
-#plt.close()
\ No newline at end of file
+
+def period_medians(df_cust_panel):
+    '''
+    median of units, amount and net amount of the meters per period since the first purchase and year of the first purchase
+    '''
+    # take median of all customer-period level pairs
+    periods = df_cust_panel.groupby(['period_since_inst', 'year'])[['amount', 'amount_net', 'units']].median()
+    return periods.reset_index()
+
+def time_series(periods, period = 90):
+    '''
+    median of units, amount and net amount per period since the first purchase, one line per year
+    periods: medians per period and year (period_medians or cons_store.summaries)
+    '''
+    import matplotlib.pyplot as plt
+
+    # line plot
+    with stage('time series'):
+        # units
+        fig, ax = plt.subplots()
+        for y in periods.year.unique():
+            input = periods.loc[periods.year == y,]
+            ax.plot(input.period_since_inst, input.units, label = f'{int(y)}')
+            ax.set_title('median of units')
+            ax.set_xlabel(f'periods since first purchase (period  = {period} days)')
+            ax.legend()
+
+        #fig.savefig(wd.parent/'figures'/'units_year.png')
+        #plt.close()
+
+        # amount
+        fig, ax = plt.subplots()
+        for y in periods.year.unique():
+            input = periods.loc[periods.year == y,]
+            ax.plot(input.period_since_inst, input.amount, label = f'{int(y)}')
+            ax.set_title('median of amount')
+            ax.set_xlabel(f'periods since first purchase (period  = {period} days)')
+            ax.legend()
+
+        #fig.savefig(wd.parent/'figures'/'amount_year.png')
+        #plt.close()
+
+        # amount net
+        fig, ax = plt.subplots()
+        for y in periods.year.unique():
+            input = periods.loc[periods.year == y,]
+            ax.plot(input.period_since_inst, input.amount_net, label = f'{int(y)}')
+            ax.set_title('median of net amount')
+            ax.set_xlabel(f'periods since first purchase (period  = {period} days)')
+            ax.legend()
+
+        #fig.savefig(wd.parent/'figures'/'amount_net_year.png')
+        #plt.close()
+
+########################
+# RUN
+#######################
+
+def run(data = wd.parent/folder, figures = wd.parent/'figures', period = 90, other_periods = [], plots = True, workers = workers, engine = 'pandas', memory_limit = None):
+    '''
+    panels of the consumption data in the folder data and, if plots, the figures in the folder figures
+    workers: processes rendering the histograms (and reading the meter store)
+    engine: 'pandas' reads cons_data_all.zip into memory, 'duckdb' runs out of core on the parquet files in
+     data/cons_data_all (see cons_duckdb.py), memory_limit of duckdb e.g. '4GB', 'store' only draws the
+     figures in one pass over data/meter_store (see cons_store.py), without panels
+    returns df (None with duckdb and store), df_cust and the panel of period (both None with store)
+    '''
+    data, figures = Path(data), Path(figures)
+    if engine == 'store':
+        import cons_store
+        df = df_cust = df_cust_panel = None
+        if plots:
+            sketches, periods = cons_store.summaries(data, period, workers)
+    elif engine == 'duckdb':
+        import cons_duckdb
+        df = None
+        df_cust, panels_p, counts = cons_duckdb.analyze(data, period, other_periods, memory_limit)
+        df_cust_panel = panels_p[period]
+        with stage('write panels'):
+            write_panel(df_cust_panel, data, 'cons_data_pmeter_panel')
+            for p in other_periods:
+                write_panel(panels_p[p], data, f'cons_data_pmeter_panel_{p}')
+    else:
+        df = load(data)
+        check_data(df)
+        df = prepare(df)
+        df, df_cust = per_meter(df)
+        df_cust_panel = panels(df, df_cust, data, period, other_periods)
+        counts = histogram_counts(df) if plots else None
+    if plots:
+        if engine != 'store':
+            sketches, periods = county_sketches(df_cust, counts), period_medians(df_cust_panel)
+        histograms(sketches, figures, workers)
+        time_series(periods, period)
+
+    # timings of the stages, if LMCP_PROFILE is set (see instrument.py)
+    write_report(data/'profile_cons_data_analysis.json')
+    return df, df_cust, df_cust_panel
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='panels and figures of the combined consumption data')
+    parser.add_argument('--data', default=wd.parent/folder, type=Path, help='folder with cons_data_all.zip (default: ../data)')
+    parser.add_argument('--figures', default=wd.parent/'figures', type=Path, help='folder of the figures (default: ../figures)')
+    parser.add_argument('--period', type=int, default=period, help='days per period of the panel')
+    parser.add_argument('--other-periods', type=int, nargs='*', default=other_periods, help='days per period of further panels')
+    parser.add_argument('--no-figures', action='store_true', help='only write the panels')
+    parser.add_argument('--workers', type=int, default=workers, help='processes rendering the histograms (default: all cpus)')
+    parser.add_argument('--engine', choices=['pandas', 'duckdb', 'store'], default='pandas', help='duckdb: out of core on data/cons_data_all/*.parquet, store: only the figures from data/meter_store')
+    parser.add_argument('--memory-limit', default=None, help='memory of the duckdb engine, e.g. 4GB')
+    args = parser.parse_args(argv)
+    run(args.data, args.figures, args.period, args.other_periods, not args.no_figures, args.workers, args.engine, args.memory_limit)
+
+
+if __name__ == '__main__':
+    main()
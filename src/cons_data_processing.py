@@ -1,36 +1,206 @@
 '''
 combine data in single file
+
+ the members of consumption.zip are read in chunks and written directly to the
+ output, the combined data is never held in memory
+
+ python cons_data_processing.py [--data ../data] [--sink parquet] [--workers 4 --pool process] [--meter-store]
+ or from python: cons_data_processing.combine(data)
 '''
 
+import io
+import shutil
+import argparse
 import pandas as pd
-from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pools import mp_context
+from zipfile import ZipFile, ZIP_DEFLATED
 from pathlib import Path
+from schema import CONSUMPTION, apply_schema
+from instrument import stage, write_report
+import meter_store
 
 
 wd = Path.cwd()
 folder = 'data'
 
-with ZipFile(wd.parent/folder/'consumption.zip', 'r') as zip:
-    file_list = []
-    for filename in zip.namelist():
-        if filename.endswith('.txt') & (filename.__contains__('archive') == False) :
-            file_list.append(filename) # all files with txt ending in list
-    # make dataframe out of first file
-    df = pd.read_csv(zip.open(file_list[0]), sep = '|')
-    for f in range(1,len(file_list)):
-        new = pd.read_csv(zip.open(file_list[f]), sep = '|')
-        if all(new.columns == df.columns): # exclude files that have different structure
-            df = df.append(new) # append all files to a df
-    
-    zip.close()
-
-# add Kilifi data
-zip = ZipFile(wd.parent/folder/'consumption.zip')
-kilifi = pd.read_csv(zip.open('consumption/Kilifi_data_20210308.txt'), sep = '|', parse_dates=['PURCHASE_DATE', 'CONNECTION_DATE'])
-
-kilifi.rename(columns = {'COUNTY':'county', 'REFERENCE_':'zrefrence','CUSTOMERNAME':'name', 'METER':'meternumber', 'INCMS_CUSTOMER_NAME':'incms_name', 'CONNECTION_DATE':'meterinstdate', 'PURCHASE_DATE':'vending_date', 'AMOUNT_KES':'amount','UNITS_KWH':'units', 'AMOUNT_LCMP_LOAN':'debt_collected'}, inplace = True)
-
-df = df.append(kilifi)
-
-# export to csv
-df.to_csv(wd.parent/'data'/'cons_data_all.zip', index=False,compression={'method': 'zip', 'archive_name': 'cons_data_all.csv'})
+# defaults of combine()
+# rows read at once
+chunksize = 500000
+# output: 'csv' -> data/cons_data_all.zip, 'parquet' -> data/cons_data_all/part-*.parquet (all columns as strings)
+sink = 'csv'
+# members read at the same time, with 1 the members are streamed in chunks
+# otherwise whole members are read in a pool of threads (decompression) or processes (parsing)
+workers = 1
+pool = 'thread'
+
+# Kilifi data has a different structure
+kilifi_file = 'consumption/Kilifi_data_20210308.txt'
+kilifi_names = {'COUNTY':'county', 'REFERENCE_':'zrefrence','CUSTOMERNAME':'name', 'METER':'meternumber', 'INCMS_CUSTOMER_NAME':'incms_name', 'CONNECTION_DATE':'meterinstdate', 'PURCHASE_DATE':'vending_date', 'AMOUNT_KES':'amount','UNITS_KWH':'units', 'AMOUNT_LCMP_LOAN':'debt_collected'}
+# meter keys are read as strings: the same in every chunk (a chunk with a missing key would parse them as float) and with leading zeros
+key_dtypes = {'meternumber':str, 'zrefrence':str}
+
+########################
+# FUNCTIONS
+#######################
+
+def header(zip, member):
+    '''
+    column names of member without reading the data
+    '''
+    return pd.read_csv(zip.open(member), sep = '|', nrows = 0).columns
+
+def valid_members(zip, file_list, columns):
+    '''
+    members of file_list with the given columns
+    '''
+    valid = []
+    for f in file_list:
+        if header(zip, f).equals(columns): # exclude files that have different structure
+            valid.append(f)
+        else:
+            print(f'skip {f}: different columns')
+    return valid
+
+def member_kwargs(read_kwargs):
+    '''
+    arguments to read a member, the meter keys as strings unless all columns are read as strings
+    '''
+    return read_kwargs if 'dtype' in read_kwargs else dict(read_kwargs, dtype = key_dtypes)
+
+def kilifi_kwargs(read_kwargs):
+    '''
+    arguments to read the Kilifi data, dates are parsed and the meter keys read as strings unless all columns are read as strings
+    '''
+    if 'dtype' in read_kwargs:
+        return read_kwargs
+    raw_names = {v: k for k, v in kilifi_names.items()}
+    return dict(read_kwargs, parse_dates = ['PURCHASE_DATE', 'CONNECTION_DATE'], dtype = {raw_names[c]: t for c, t in key_dtypes.items()})
+
+def compact(df, read_kwargs):
+    '''
+    dtypes of schema.CONSUMPTION, unless all columns are read as strings
+    '''
+    return df if 'dtype' in read_kwargs else apply_schema(df, CONSUMPTION)
+
+def consumption_chunks(zip, members, chunksize, **read_kwargs):
+    '''
+    yield chunks of all members, followed by the Kilifi data
+    '''
+    for f in members:
+        for chunk in pd.read_csv(zip.open(f), sep = '|', chunksize = chunksize, **member_kwargs(read_kwargs)):
+            yield compact(chunk, read_kwargs)
+    # add Kilifi data
+    for chunk in pd.read_csv(zip.open(kilifi_file), sep = '|', chunksize = chunksize, **kilifi_kwargs(read_kwargs)):
+        yield compact(chunk.rename(columns = kilifi_names), read_kwargs)
+
+def read_consumption_member(path, member, **read_kwargs):
+    '''
+    read a whole member of the zip file path, run in the threads or processes of consumption_frames
+    '''
+    with ZipFile(path) as zip:
+        if member == kilifi_file:
+            return compact(pd.read_csv(zip.open(member), sep = '|', **kilifi_kwargs(read_kwargs)).rename(columns = kilifi_names), read_kwargs)
+        return compact(pd.read_csv(zip.open(member), sep = '|', **member_kwargs(read_kwargs)), read_kwargs)
+
+def consumption_frames(path, members, workers, pool = 'thread', **read_kwargs):
+    '''
+    read all members and the Kilifi data concurrently, returns the dataframes in the order of members
+    '''
+    if pool == 'process':
+        executor = ProcessPoolExecutor(workers, mp_context = mp_context())
+    else:
+        executor = ThreadPoolExecutor(workers)
+    with executor as ex:
+        futures = [ex.submit(read_consumption_member, path, f, **read_kwargs) for f in members + [kilifi_file]]
+        return [future.result() for future in futures]
+
+def write_csv(chunks, columns, path, archive_name):
+    '''
+    write chunks as single csv file archive_name in the zip file path, returns the number of rows
+    '''
+    rows = 0
+    with ZipFile(path, 'w', compression = ZIP_DEFLATED) as zip:
+        with io.TextIOWrapper(zip.open(archive_name, 'w', force_zip64 = True), encoding = 'utf-8', newline = '') as f:
+            for i, chunk in enumerate(chunks):
+                chunk.reindex(columns = columns).to_csv(f, index = False, header = (i == 0))
+                rows += len(chunk)
+    return rows
+
+def write_parquet(chunks, columns, path):
+    '''
+    write each chunk as parquet file in the folder path, all columns as strings for a common schema
+    returns the number of rows
+    '''
+    if path.exists():
+        shutil.rmtree(path)
+    path.mkdir(parents = True)
+    rows = 0
+    for i, chunk in enumerate(chunks):
+        chunk.reindex(columns = columns).astype('string').to_parquet(path/f'part-{i:05d}.parquet', index = False)
+        rows += len(chunk)
+    return rows
+
+########################
+# COMBINE
+#######################
+
+def combine(data, sink = 'csv', chunksize = 500000, workers = 1, pool = 'thread', store = False):
+    '''
+    combine the members of data/consumption.zip in data/cons_data_all.zip (sink = 'csv') or data/cons_data_all (sink = 'parquet')
+    store: also build the per-meter store data/meter_store (see meter_store.py), the chunks are split by meter in data/cache/meter_store first
+    returns the number of rows written
+    '''
+    data = Path(data)
+    with ZipFile(data/'consumption.zip', 'r') as zip:
+        with stage('list members'):
+            file_list = []
+            for filename in zip.namelist():
+                if filename.endswith('.txt') & (filename.__contains__('archive') == False) & (filename != kilifi_file):
+                    file_list.append(filename) # all files with txt ending in list
+            # structure of first file, Kilifi columns are added at the end
+            columns = header(zip, file_list[0])
+            kilifi_columns = header(zip, kilifi_file).map(lambda c: kilifi_names.get(c, c))
+            out_columns = columns.append(kilifi_columns.difference(columns, sort = False))
+
+            members = valid_members(zip, file_list, columns)
+
+        # members are read while the output is written
+        with stage(f'read and write {sink}') as st:
+            read_kwargs = {'dtype': str} if sink == 'parquet' else {}
+            if workers > 1:
+                chunks = consumption_frames(data/'consumption.zip', members, workers, pool, **read_kwargs)
+            else:
+                chunks = consumption_chunks(zip, members, chunksize, **read_kwargs)
+            if store:
+                chunks = meter_store.collect(chunks, data/'cache'/'meter_store')
+
+            if sink == 'parquet':
+                rows = write_parquet(chunks, out_columns, data/'cons_data_all')
+            else:
+                # export to csv
+                rows = write_csv(chunks, out_columns, data/'cons_data_all.zip', 'cons_data_all.csv')
+            st.rows_out = rows
+
+    if store:
+        with stage('meter store', rows_in = rows):
+            meter_store.build(data/'cache'/'meter_store', data/'meter_store')
+
+    # timings of the stages, if LMCP_PROFILE is set (see instrument.py)
+    write_report(data/'profile_cons_data_processing.json')
+    return rows
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='combine the consumption data in a single file')
+    parser.add_argument('--data', default=wd.parent/folder, type=Path, help='folder with consumption.zip (default: ../data)')
+    parser.add_argument('--sink', choices=['csv', 'parquet'], default=sink)
+    parser.add_argument('--chunksize', type=int, default=chunksize)
+    parser.add_argument('--workers', type=int, default=workers)
+    parser.add_argument('--pool', choices=['thread', 'process'], default=pool)
+    parser.add_argument('--meter-store', action='store_true', help='also build data/meter_store, the purchases sorted by meter (see meter_store.py)')
+    args = parser.parse_args(argv)
+    combine(args.data, args.sink, args.chunksize, args.workers, args.pool, args.meter_store)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+'''
+out-of-core engine of the consumption analysis (duckdb)
+
+ the collapse of purchases on the same day, the time between purchases, the
+ aggregates per meter, the panels and the value counts of the histograms run
+ as queries over data/cons_data_all/*.parquet (cons_data_processing.py --sink parquet);
+ duckdb spills to data/cache/duckdb when the data does not fit in memory_limit,
+ only the results per meter, the panels and the counts come back to pandas
+
+ same results as cons_data_analysis.py with engine = 'pandas', up to the rounding
+ of the sums (duckdb sums in double), text columns come back as strings
+'''
+
+from pathlib import Path
+from instrument import stage
+
+# columns of a meter, taken from its first purchase, in the order of the files (see purchases)
+attributes = ['county', 'zrefrence', 'name', 'meternumber', 'meterinstdate', 'incms_name']
+
+########################
+# FUNCTIONS
+#######################
+
+def connect(data, memory_limit = None, threads = None):
+    '''
+    in-memory duckdb that spills to data/cache/duckdb
+    memory_limit: e.g. '4GB', default of duckdb: 80% of the memory
+    '''
+    import duckdb
+    (Path(data)/'cache'/'duckdb').mkdir(parents=True, exist_ok=True)
+    con = duckdb.connect()
+    con.execute(f"SET temp_directory = '{Path(data)/'cache'/'duckdb'}'")
+    if memory_limit is not None:
+        con.execute(f"SET memory_limit = '{memory_limit}'")
+    if threads is not None:
+        con.execute(f'SET threads = {int(threads)}')
+    return con
+
+def purchases(con, data):
+    '''
+    table tx: one row per meter and vending date with the sums of amount, units and debt_collected,
+    the other columns of the first row in the files, days since the last purchase, net amount, year,
+    first vending date and purchases in the year of the meter
+    returns the attributes in the order of the columns of the files, as the pandas engine keeps them
+    '''
+    files = Path(data)/'cons_data_all'
+    if not files.exists():
+        raise FileNotFoundError(f'{files} not found, write it with cons_data_processing.py --sink parquet')
+    names = [r[0] for r in con.execute(f"DESCRIBE SELECT * FROM read_parquet('{files/'*.parquet'}')").fetchall()]
+    order = sorted(attributes, key = names.index)
+    with stage('collapse'):
+        first = ', '.join(f'first({c} ORDER BY filename, file_row_number) AS {c}' for c in attributes if c != 'meternumber')
+        con.execute(f'''
+            CREATE OR REPLACE TEMP TABLE tx AS
+            WITH raw AS (
+                SELECT county, zrefrence, name, meternumber, incms_name, filename, file_row_number,
+                       CAST(meterinstdate AS TIMESTAMP) AS meterinstdate, CAST(vending_date AS TIMESTAMP) AS vending_date,
+                       CAST(amount AS DOUBLE) AS amount, CAST(units AS DOUBLE) AS units, CAST(debt_collected AS DOUBLE) AS debt_collected
+                FROM read_parquet('{files/'*.parquet'}', filename = true, file_row_number = true)
+            ),
+            collapse AS (
+                SELECT meternumber, vending_date, {first},
+                       coalesce(sum(amount), 0) AS amount, coalesce(sum(units), 0) AS units, coalesce(sum(debt_collected), 0) AS debt_collected
+                FROM raw
+                WHERE meternumber IS NOT NULL AND vending_date IS NOT NULL
+                GROUP BY meternumber, vending_date
+            )
+            SELECT *,
+                   date_diff('second', lag(vending_date) OVER (PARTITION BY meternumber ORDER BY vending_date), vending_date) // 86400 AS days_elapsed,
+                   amount - debt_collected AS amount_net,
+                   year(vending_date) AS year,
+                   min(vending_date) OVER (PARTITION BY meternumber) AS first_vending_date,
+                   count(*) OVER (PARTITION BY meternumber, year(vending_date)) AS no_purch_year
+            FROM collapse
+        ''')
+    return order
+
+def customers(con, columns = attributes):
+    '''
+    table cust and its dataframe: one row per meter with first and last vending date, number of purchases and
+    the gap between meterinstdate and first purchase, sorted by meter
+    columns: the attributes in the order of the files (returned by purchases)
+    '''
+    with stage('per meter') as st:
+        con.execute(f'''
+            CREATE OR REPLACE TEMP TABLE cust AS
+            SELECT {', '.join('tx.' + c for c in columns)}, tx.first_vending_date, m.last_vending_date,
+                   year(tx.first_vending_date) AS year, m.no_purchase, tx.first_vending_date - tx.meterinstdate AS gap
+            FROM tx JOIN (SELECT meternumber, max(vending_date) AS last_vending_date, count(*) AS no_purchase FROM tx GROUP BY meternumber) m
+                 ON tx.meternumber = m.meternumber
+            WHERE tx.vending_date = tx.first_vending_date
+        ''')
+        df_cust = con.execute('SELECT * FROM cust ORDER BY meternumber').df()
+        st.rows_out = len(df_cust)
+    return df_cust
+
+def panel(con, period, col):
+    '''
+    amount and units per meter and period (1, 2, ...) of period days since the first purchase (column col), with the columns of cust
+    the last, incomplete period is left out as in cons_data_analysis.period_since
+    '''
+    with stage(f'panel {period}') as st:
+        seconds = period*86400
+        df = con.execute(f'''
+            WITH p AS (
+                SELECT meternumber, date_diff('second', first_vending_date, vending_date) // {seconds} + 1 AS {col}, amount, amount_net, units
+                FROM tx
+            ),
+            amount_pp AS (
+                SELECT meternumber, CAST({col} AS DOUBLE) AS {col}, sum(amount) AS amount, sum(amount_net) AS amount_net, sum(units) AS units
+                FROM p
+                WHERE {col} <= (SELECT max(date_diff('second', first_vending_date, vending_date)) // {seconds} FROM tx)
+                GROUP BY meternumber, {col}
+            )
+            SELECT cust.*, amount_pp.* EXCLUDE (meternumber)
+            FROM cust JOIN amount_pp ON cust.meternumber = amount_pp.meternumber
+            ORDER BY cust.meternumber, amount_pp.{col}
+        ''').df()
+        st.rows_out = len(df)
+    return df
+
+def histogram_counts(con):
+    '''
+    number of rows per county and value of no_purch_year and of the days between purchases (see cons_data_analysis.histogram_counts)
+    '''
+    with stage('histogram counts'):
+        counts = []
+        for col in ['no_purch_year', 'days_elapsed']:
+            df = con.execute(f'SELECT county, {col}, count(*) AS n FROM tx WHERE {col} IS NOT NULL GROUP BY county, {col} ORDER BY county, {col}').df()
+            counts.append(df.set_index(['county', col])['n'])
+    return counts
+
+def analyze(data, period = 90, other_periods = [], memory_limit = None, threads = None):
+    '''
+    customers, panels {period: panel} and histogram counts of the parquet files in data/cons_data_all
+    '''
+    con = connect(data, memory_limit, threads)
+    try:
+        order = purchases(con, data)
+        df_cust = customers(con, order)
+        panels = {p: panel(con, p, 'period_since_inst' if p == period else f'period_since_inst_{p}') for p in [period] + list(other_periods)}
+        counts = histogram_counts(con)
+    finally:
+        con.close()
+    return df_cust, panels, counts
@@ -0,0 +1,135 @@
+'''
+one-pass engine of the consumption figures on the meter store (meter_store.py)
+
+ the purchases are read in blocks of meters from the memory-mapped arrays in data/meter_store
+ (cons_data_processing.py --meter-store), each block adds to mergeable sketches (sketches.py):
+ value counts per county for the histograms and quantile sketches of the sums per meter and
+ period for the medians of the time series; the blocks can run in processes, their sketches
+ are merged, no more than a block of purchases is in memory
+
+ the histograms are the same as with engine = 'pandas', the medians are approximate (KLL);
+ all purchases of a meter count to the county of its first purchase
+'''
+
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from functools import reduce
+from concurrent.futures import ProcessPoolExecutor
+from pools import mp_context
+from instrument import stage
+from meter_store import MeterStore
+from sketches import KLL, Histogram
+
+# columns of the time series
+columns = ['amount', 'amount_net', 'units']
+day = np.timedelta64(1, 'D')
+
+########################
+# FUNCTIONS
+#######################
+
+def runs(*keys):
+    '''
+    number of the run of equal keys of each row (the rows are sorted by meter and date)
+    '''
+    change = np.zeros(len(keys[0]), dtype = bool)
+    change[:1] = True
+    for k in keys:
+        change[1:] |= k[1:] != k[:-1]
+    return np.cumsum(change) - 1
+
+def block_sketches(path, lo, hi, period, max_p):
+    '''
+    sketches of the meters lo to hi - 1 of the store in the folder path
+    returns {county: [meterinstdate, gap, no_purch_year, time_elapsed]} value counts and
+     {(period_since_inst, year): {column: KLL}} of the sums per meter and period
+    '''
+    store = MeterStore(path)
+    offsets = np.asarray(store.offsets[lo:hi + 1])
+    rows = slice(int(offsets[0]), int(offsets[-1]))
+    # meter of each row, 0 .. hi - lo - 1
+    meter = np.repeat(np.arange(hi - lo), np.diff(offsets))
+    date = np.asarray(store.rows['vending_date'][rows])
+    year = pd.DatetimeIndex(date).year.to_numpy()
+
+    # per meter: county, year of installation, first purchase and gap in days
+    county = np.asarray(store.county[lo:hi])
+    inst = np.asarray(store.meterinstdate[lo:hi])
+    first = date[offsets[:-1] - offsets[0]]
+    first_year = pd.DatetimeIndex(first).year.to_numpy()
+    inst_year = pd.DatetimeIndex(inst).year.to_numpy(dtype = np.float64, na_value = np.nan)
+    gap = np.floor((first - inst)/day)
+
+    # per row: purchases of the meter in the year, days since the last purchase
+    group = runs(meter, year)
+    no_purch_year = np.bincount(group)[group]
+    days_elapsed = np.floor(np.asarray(store.rows['time_elapsed'][rows])/day)
+
+    hists = {}
+    for c in np.unique(county):
+        # rows without a county are left out as in the groupby of the pandas engine
+        if c == 'nan':
+            continue
+        m = county == c
+        r = m[meter]
+        hists[c] = [Histogram().update(inst_year[m]), Histogram().update(gap[m]),
+                    Histogram().update(no_purch_year[r]), Histogram().update(days_elapsed[r])]
+
+    # sums per meter and period, the last, incomplete period is left out as in cons_data_analysis.period_since
+    p = (date - first[meter])//np.timedelta64(period, 'D') + 1
+    group = runs(meter, p)
+    amount = np.asarray(store.rows['amount'][rows])
+    values = {'amount': amount, 'amount_net': amount - np.asarray(store.rows['debt_collected'][rows]), 'units': np.asarray(store.rows['units'][rows])}
+    start = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    sums = pd.DataFrame({'period_since_inst': p[start], 'year': first_year[meter[start]], **{c: np.bincount(group, weights = v) for c, v in values.items()}})
+    sums = sums[sums['period_since_inst'] <= max_p]
+
+    quantiles = {}
+    for key, s in sums.groupby(['period_since_inst', 'year'], sort = False):
+        quantiles[key] = {c: KLL(seed = lo).update(s[c]) for c in columns}
+    return hists, quantiles
+
+def merge(a, b):
+    '''
+    sketches b of a block added to the sketches a
+    '''
+    for (ours, theirs) in zip(a, b):
+        for key, s in theirs.items():
+            if key not in ours:
+                ours[key] = s
+            elif isinstance(s, list):
+                for x, y in zip(ours[key], s):
+                    x.merge(y)
+            else:
+                for c in s:
+                    ours[key][c].merge(s[c])
+    return a
+
+def summaries(data, period = 90, workers = 1, block = 50000):
+    '''
+    value counts of the histograms of each county and medians per period and year of the store in data/meter_store
+    workers: processes reading the blocks of block meters
+    returns {county: [meterinstdate, gap, no_purch_year, time_elapsed]} (see cons_data_analysis.county_sketches),
+     the medians per period and year (see cons_data_analysis.period_medians)
+    '''
+    path = Path(data)/'meter_store'
+    if not (path/'store.json').exists():
+        raise FileNotFoundError(f'{path} not found, write it with cons_data_processing.py --meter-store')
+    store = MeterStore(path)
+    with stage('store sketches', rows_in = int(store.offsets[-1])) as st:
+        # maximum number of complete periods, from the first and last purchase of each meter
+        max_p = int((store.last_vending_date - store.first_vending_date).max()//np.timedelta64(period, 'D'))
+        lo = list(range(0, len(store), block))
+        hi = lo[1:] + [len(store)]
+        args = [[path]*len(lo), lo, hi, [period]*len(lo), [max_p]*len(lo)]
+        if workers > 1 and len(lo) > 1:
+            with ProcessPoolExecutor(workers, mp_context = mp_context()) as ex:
+                hists, quantiles = reduce(merge, ex.map(block_sketches, *args), ({}, {}))
+        else:
+            hists, quantiles = reduce(merge, map(block_sketches, *args), ({}, {}))
+
+        periods = pd.DataFrame([{'period_since_inst': float(p), 'year': y, **{c: q[c].median() for c in columns}} for (p, y), q in sorted(quantiles.items())],
+                               columns = ['period_since_inst', 'year'] + columns)
+        st.rows_out = len(periods)
+    return hists, periods
@@ -0,0 +1,138 @@
+'''
+timing of the stages of the scripts
+
+ with stage('load') as s:
+     df = ...
+     s.rows_out = len(df)
+
+ @timed('match')
+ def match_and_merge(...)
+
+ switched on by the environment variable LMCP_PROFILE:
+  1         wall and cpu seconds, rows in/out and memory (RSS) before/after of every stage
+  cprofile  in addition a cProfile of every stage, written as .prof files next to the report
+ write_report(path) writes the stages as json; without LMCP_PROFILE, stage() returns a
+ shared object that does nothing, timed() returns the function itself and write_report
+ does not write anything
+'''
+
+import os
+import sys
+import json
+import time
+import cProfile
+import functools
+from pathlib import Path
+
+MODE = os.environ.get('LMCP_PROFILE', '').lower()
+ENABLED = MODE not in ['', '0', 'false', 'off']
+PROFILE = MODE == 'cprofile'
+
+# recorded stages in the order they finished, depth is the number of stages they ran in
+stages = []
+# stages that are running
+running = []
+# only one cProfile can run at a time, nested stages are part of the profile of the outer stage
+profiling = []
+
+########################
+# FUNCTIONS
+#######################
+
+def rss():
+    '''
+    resident set size of this process in MB, the peak on systems without /proc, nan on windows
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except OSError:
+        # resource is unix only
+        try:
+            import resource
+        except ImportError:
+            return float('nan')
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak/2**20 if sys.platform == 'darwin' else peak/2**10
+
+class Stage:
+    '''
+    context manager that records one stage, rows_in and rows_out can be set inside the block
+    '''
+    def __init__(self, name, rows_in = None):
+        self.name, self.rows_in, self.rows_out = name, rows_in, None
+
+    def __enter__(self):
+        self.profile = cProfile.Profile() if PROFILE and not profiling else None
+        self.depth = len(running)
+        running.append(self)
+        self.rss = rss()
+        self.cpu, self.wall = time.process_time(), time.perf_counter()
+        if self.profile is not None:
+            profiling.append(self)
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile is not None:
+            self.profile.disable()
+            profiling.remove(self)
+        wall, cpu = time.perf_counter() - self.wall, time.process_time() - self.cpu
+        running.remove(self)
+        after = rss()
+        stages.append({'stage': self.name, 'depth': self.depth, 'seconds': wall, 'cpu_seconds': cpu, 'rows_in': self.rows_in, 'rows_out': self.rows_out,
+                       'rss_mb': after, 'rss_delta_mb': after - self.rss, 'failed': exc[0] is not None, 'profile': self.profile})
+        return False
+
+class Off:
+    '''
+    stage when the instrumentation is off: ignores everything
+    '''
+    __slots__ = ()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+    def __setattr__(self, name, value):
+        pass
+
+OFF = Off()
+
+def stage(name, rows_in = None):
+    '''
+    context manager recording the stage name (see Stage), does nothing if LMCP_PROFILE is not set
+    '''
+    return Stage(name, rows_in) if ENABLED else OFF
+
+def timed(name = None):
+    '''
+    decorator recording each call of the function as a stage (default: name of the function)
+    '''
+    def decorate(f):
+        if not ENABLED:
+            return f
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with Stage(name or f.__name__):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def write_report(path):
+    '''
+    write the recorded stages to the json file path, the profiles to path_{i}_{stage}.prof
+    '''
+    if not ENABLED:
+        return
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    report = []
+    for i, s in enumerate(stages):
+        s = dict(s)
+        profile = s.pop('profile')
+        if profile is not None:
+            prof = path.with_name(f'{path.stem}_{i:02d}_{"".join(c if c.isalnum() else "_" for c in s["stage"])}.prof')
+            profile.dump_stats(prof)
+            s['profile'] = prof.name
+        report.append(s)
+    path.write_text(json.dumps(report, indent=2))
@@ -0,0 +1,102 @@
+'''
+load files from the zip archives in data
+
+ each archive member is parsed once and stored as parquet in data/cache,
+ the name of the cached file depends on the CRC, size and date of the member
+ and on the arguments used to parse it
+'''
+
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+from zipfile import ZipFile
+from pathlib import Path
+from schema import apply_schema
+from instrument import stage
+
+
+def cache_key(info, read_kwargs):
+    '''
+    hash of the zip member (ZipInfo) and the arguments used to parse it
+    '''
+    key = repr((info.filename, info.CRC, info.file_size, info.date_time, sorted(read_kwargs.items(), key=lambda x: x[0])))
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+def parse_member(zip, member, **read_kwargs):
+    '''
+    parse member of the open ZipFile zip, stata files with read_stata, all others with read_csv
+    '''
+    if member.endswith('.dta'):
+        return pd.read_stata(zip.open(member), **read_kwargs)
+    return pd.read_csv(zip.open(member), **read_kwargs)
+
+def write_cache(df, path):
+    '''
+    store df as parquet file path, nothing is stored if pyarrow cannot convert df or no parquet engine is installed
+    '''
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first so that an interrupted run leaves no broken cache
+    tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        df.to_parquet(tmp)
+        os.replace(tmp, path)
+    except (ValueError, TypeError, ImportError):
+        # columns with mixed types cannot be stored, without pyarrow or fastparquet nothing can: use the data without cache
+        tmp.unlink(missing_ok=True)
+
+def read_cache(path, columns = None):
+    '''
+    read parquet file path written by write_cache
+    '''
+    df = pd.read_parquet(path, columns=columns)
+    # missing strings come back as None, read_csv gives np.nan
+    for c in df.columns[df.dtypes == object]:
+        values = df[c].to_numpy(copy=True)
+        values[pd.isnull(values)] = np.nan
+        df[c] = values
+    return df
+
+def member_key(zip_path, member, **read_kwargs):
+    '''
+    cache_key of member in the archive zip_path
+    '''
+    with ZipFile(zip_path) as zip:
+        return cache_key(zip.getinfo(member), read_kwargs)
+
+def cached(name, key, build, cache_dir):
+    '''
+    dataframe returned by build(), stored in cache_dir under name and key and read from there if it exists
+    key: anything with a stable repr that identifies the inputs of build, e.g. member_key and a version number
+    '''
+    key = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    path = Path(cache_dir)/f'{name}_{key}.parquet'
+    if path.exists():
+        return read_cache(path)
+    df = build()
+    write_cache(df, path)
+    return df
+
+def read_member(zip_path, member, columns = None, cache_dir = None, schema = None, **read_kwargs):
+    '''
+    read member of the archive zip_path as dataframe
+    columns: only load these columns
+    cache_dir: folder for the parquet files, defaults to cache next to the archive
+    schema: dtypes applied after parsing, see schema.py
+    read_kwargs: passed to read_csv or read_stata, e.g. sep = '|'
+    '''
+    zip_path = Path(zip_path)
+    cache_dir = zip_path.parent/'cache' if cache_dir is None else Path(cache_dir)
+    with stage(f'read {member}') as s, ZipFile(zip_path) as zip:
+        info = zip.getinfo(member)
+        path = cache_dir/f'{Path(member).stem}_{cache_key(info, dict(read_kwargs, schema=schema))}.parquet'
+        if path.exists():
+            df = read_cache(path, columns)
+        else:
+            df = parse_member(zip, member, **read_kwargs)
+            if schema is not None:
+                apply_schema(df, schema)
+            write_cache(df, path)
+            df = df if columns is None else df[columns]
+        s.rows_out = len(df)
+    return df
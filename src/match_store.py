@@ -0,0 +1,105 @@
+'''
+persistent store of the fuzzy matches (sqlite)
+
+ the scores of a pre-/postpaid record only depend on its value, the candidate
+ rows of its block and the parameters of the pass, so they are stored under a hash
+ of these three; a rerun with new extracts only scores new or changed records
+ and blocks whose survey rows changed (see match_and_merge(store = ...))
+
+ a record keeps its ranks (matching.block_ranks): the distinct scores of the candidate
+ rows and the first row with each, a few bytes from which the match for any cutoff
+ is read (matching.rank_matches), so the cutoff is not part of the parameters
+
+ the store keeps the max_rows most recently used records: split marks the blocks it
+ finds as used, save removes the least recently used records beyond max_rows
+'''
+
+import time
+import hashlib
+import sqlite3
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+# layout of the tables, stored as user_version of the database
+VERSION = 2
+# records kept by save()
+max_rows = 1000000
+
+def connect(path):
+    '''
+    open (and create) the store at path, a store of another VERSION is emptied
+    '''
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(str(path))
+    if con.execute('PRAGMA user_version').fetchone()[0] != VERSION:
+        with con:
+            # version 1 (or none): matches stored per cutoff
+            con.execute('DROP TABLE IF EXISTS matches')
+            con.execute('DROP TABLE IF EXISTS ranks')
+            con.execute('CREATE TABLE ranks (params TEXT, block TEXT, query INTEGER, scores BLOB, rows BLOB, last_used INTEGER, PRIMARY KEY (params, block, query))')
+            con.execute('CREATE INDEX ranks_last_used ON ranks (last_used)')
+            con.execute(f'PRAGMA user_version = {VERSION}')
+    return con
+
+def params_key(*params):
+    '''
+    hash of the parameters of a pass, functions by their name
+    '''
+    key = repr([getattr(p, '__name__', p) for p in params])
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+def block_key(candidates, cols):
+    '''
+    hash of the candidate rows of a block: index, order and the values in cols
+    '''
+    hashes = pd.util.hash_pandas_object(candidates[cols], index=True).to_numpy()
+    return hashlib.sha1(hashes.tobytes()).hexdigest()[:16]
+
+def value_keys(s):
+    '''
+    hash of each value of the series s as signed 64 bit integer (sqlite INTEGER)
+    '''
+    return pd.util.hash_array(s.to_numpy(dtype=object)).view(np.int64)
+
+def split(con, params, tasks, col, cols):
+    '''
+    look up the rows of each (rows of df, candidates) pair in the store
+    returns the stored (rows of df, candidates, ranks) of the rows found, the pairs with the rows not found and their block keys
+    the blocks with rows found count as used now
+    '''
+    found, remaining, blocks, used = [], [], [], []
+    for df_block, candidates in tasks:
+        block = block_key(candidates, cols)
+        stored = {q: (np.frombuffer(s, dtype=np.uint8), np.frombuffer(r, dtype=np.int32)) for q, s, r in con.execute('SELECT query, scores, rows FROM ranks WHERE params = ? AND block = ?', (params, block))}
+        queries = value_keys(df_block[col])
+        hit = np.array([q in stored for q in queries], dtype=bool)
+        if hit.any():
+            found.append((df_block[hit], candidates, [stored[q] for q in queries[hit]]))
+            used.append(block)
+        if not hit.all():
+            remaining.append((df_block[~hit], candidates))
+            blocks.append(block)
+    if used:
+        now = time.time_ns()
+        with con:
+            con.executemany('UPDATE ranks SET last_used = ? WHERE params = ? AND block = ?', ((now, params, b) for b in used))
+    return found, remaining, blocks
+
+def save(con, params, tasks, blocks, ranks, col, rows_kept = None):
+    '''
+    store the ranks {index in df: (scores, rows)} of the (rows of df, candidates) pairs scored after split
+    rows_kept: records kept in the store (default: max_rows), the least recently used others are removed
+    '''
+    rows_kept = max_rows if rows_kept is None else rows_kept
+    now = time.time_ns()
+    rows = []
+    for (df_block, candidates), block in zip(tasks, blocks):
+        for i, q in zip(df_block.index, value_keys(df_block[col])):
+            scores, pos = ranks[i]
+            rows.append((params, block, int(q), scores.astype(np.uint8).tobytes(), pos.astype(np.int32).tobytes(), now))
+    with con:
+        con.executemany('INSERT OR REPLACE INTO ranks VALUES (?, ?, ?, ?, ?, ?)', rows)
+        n = con.execute('SELECT count(*) FROM ranks').fetchone()[0]
+        if n > rows_kept:
+            con.execute('DELETE FROM ranks WHERE rowid IN (SELECT rowid FROM ranks ORDER BY last_used LIMIT ?)', (n - rows_kept,))
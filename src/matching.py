@@ -0,0 +1,335 @@
+'''
+fuzzy matching of pre-/postpaid records with the survey
+
+ candidates are grouped by transno once (block_index) and each block is scored
+ as a whole with rapidfuzz instead of calling fuzzywuzzy row by row; rapidfuzz has
+ the scores of fuzzywuzzy with python-Levenshtein, without it (difflib) the rows are
+ scored by fuzzywuzzy as before
+'''
+
+import pandas as pd
+import numpy as np
+import heapq
+import difflib
+from concurrent.futures import ProcessPoolExecutor
+from pools import mp_context
+
+from fuzzywuzzy import process, fuzz, utils
+from rapidfuzz import process as rf_process, fuzz as rf_fuzz
+import match_store
+
+# fuzzywuzzy scorers that can be computed in batch:
+# scorer -> (rapidfuzz equivalent, force_ascii used by fuzzywuzzy's preprocessing in extractOne)
+SCORERS = {
+    fuzz.ratio: (rf_fuzz.ratio, False),
+    fuzz.token_set_ratio: (rf_fuzz.token_set_ratio, True),
+    fuzz.token_sort_ratio: (rf_fuzz.token_sort_ratio, True),
+}
+# rapidfuzz gives the scores of fuzzywuzzy with python-Levenshtein, not of its fallback on difflib
+LEVENSHTEIN = fuzz.SequenceMatcher is not difflib.SequenceMatcher
+
+########################
+# FUNCTIONS
+#######################
+
+def block_index(df_choices, common = 'transno', by_county = False):
+    '''
+    group the rows of df_choices once by common (and county)
+    returns a dictionary {key: candidate rows}, used by get_match instead of
+    masking the full df_choices for every entry
+    '''
+    keys = [common, 'county'] if by_county else common
+    return {k: g for k, g in df_choices.groupby(keys, sort = False, observed = True)}
+
+def get_match(df, col, df_choices, col_choices, common, cutoff = 80, method = fuzz.ratio, blocks = None, by_county = False):
+    '''
+    get best match for each entry in df[col]
+    common: column which needs to be the same for both dataframes (transno)
+    cutoff: minimum similarity
+    method: get more info here: https://pypi.org/project/fuzzywuzzy/
+    blocks: output of block_index(df_choices, common, by_county), built here if None
+    '''
+    if blocks is None:
+        blocks = block_index(df_choices, common, by_county)
+    # candidate rows sharing the same transno (and county)
+    key = (df[common], df['county']) if by_county else df[common]
+    candidates = blocks.get(key)
+    if candidates is None:
+        return None
+    # initialize dictionary
+    matches = {}
+    # loop through rows in candidates
+    for i,r in candidates.iterrows():
+        # extract entries from col_choices
+        row_pos = [r[c] for c in col_choices if r[c] is not np.nan]
+        # find the best match among col_choices
+        try: match_row = process.extractOne(df[col],row_pos,score_cutoff=cutoff,scorer = method)
+        except: continue
+        # add to dictionary
+        if match_row is not None:
+            matches[i] = match_row[1]
+    # find the best match among all rows
+    if len(matches) >0:
+        matches_sorted = dict(sorted(matches.items(), key=lambda x:x[1]))
+        max_match = (list(matches_sorted.keys())[0], list(matches_sorted.values())[0])
+        # return best match (index in df_choices, similarity score)
+        dct= {'survey_i':max_match[0], 'pp_i':df.name, 'score':max_match[1]}
+        return dct
+
+def batched(method):
+    '''
+    whether method is scored in batch with rapidfuzz (same scores as fuzzywuzzy), otherwise row by row with get_match
+    '''
+    return LEVENSHTEIN and (method in SCORERS)
+
+def process_strings(strings, force_ascii):
+    '''
+    fuzzywuzzy's full_process of strings, every distinct string is processed once
+    '''
+    codes, unique = pd.factorize(np.asarray(strings, dtype=object))
+    return np.array([utils.full_process(u, force_ascii=force_ascii) for u in unique] + [''], dtype=object)[codes]
+
+def token_forms(processed, method):
+    '''
+    processed strings as method compares them, every distinct string is tokenized once:
+    tokens sorted for token_sort_ratio, sorted and without repeats for token_set_ratio, unchanged for ratio
+    strings with the same form have the same score with any other string
+    '''
+    if method is fuzz.ratio:
+        return processed
+    codes, unique = pd.factorize(np.asarray(processed, dtype=object))
+    tokens = [u.split() for u in unique]
+    if method is fuzz.token_set_ratio:
+        tokens = [set(t) for t in tokens]
+    return np.array([' '.join(sorted(t)) for t in tokens] + [''], dtype=object)[codes]
+
+def fix_scores(raw, s1, s2, method):
+    '''
+    integer scores of fuzzywuzzy from the float scores raw of rapidfuzz for the processed strings s1 and s2
+    (arrays of the same shape as raw)
+    '''
+    scores = np.rint(raw)
+    # fuzzywuzzy rounds intermediate ratios, rescore pairs close to x.5 with fuzzywuzzy itself
+    for i in zip(*np.nonzero(np.abs(raw - np.floor(raw) - 0.5) < 1e-6)):
+        scores[i] = method(s1[i], s2[i]) if method is fuzz.ratio else method(s1[i], s2[i], full_process=False)
+    # identical strings (also two empty strings) score 100 in fuzzywuzzy
+    scores[s1 == s2] = 100
+    return scores.astype(int)
+
+def score_matrix(queries, choices, method = fuzz.ratio):
+    '''
+    similarity of every query with every choice as integer matrix (len(queries) x len(choices))
+    same scores as process.extractOne(query, choices, scorer=method) of fuzzywuzzy
+    method: one of the keys of SCORERS
+    '''
+    rf_scorer, force_ascii = SCORERS[method]
+    # preprocess and tokenize every distinct string once, as fuzzywuzzy does for each comparison
+    q_codes, q = pd.factorize(token_forms(process_strings(queries, force_ascii), method))
+    c_codes, c = pd.factorize(token_forms(process_strings(choices, force_ascii), method))
+    # score all pairs of distinct forms in C
+    raw = rf_process.cdist(q, c, scorer=rf_scorer, processor=None, dtype=np.float64)
+    scores = fix_scores(raw, np.broadcast_to(q[:, None], raw.shape), np.broadcast_to(c[None, :], raw.shape), method)
+    return scores[np.ix_(q_codes, c_codes)]
+
+def score_pairs(queries, choices, method = fuzz.ratio):
+    '''
+    similarity of queries[i] with choices[i], same scores as score_matrix
+    '''
+    rf_scorer, force_ascii = SCORERS[method]
+    q, c = process_strings(queries, force_ascii), process_strings(choices, force_ascii)
+    raw = rf_process.cpdist(q, c, scorer=rf_scorer, processor=None, dtype=np.float64)
+    return fix_scores(raw, q, c, method)
+
+def best_scores(queries, choices, method = fuzz.ratio):
+    '''
+    highest score of each query among the strings of its row in choices (len(queries) x number of choices)
+    same scores as process.extractOne(queries[i], choices[i], scorer=method)[1] of fuzzywuzzy
+    method: one of the keys of SCORERS
+    '''
+    rows, cols = np.indices(choices.shape).reshape(2, -1)
+    scores = score_pairs(queries[rows], choices[rows, cols], method)
+    return scores.reshape(choices.shape).max(axis=1)
+
+def block_ranks(df, col, candidates, col_choices, method = fuzz.ratio):
+    '''
+    scores of each row of df with the candidate rows (best entry of get_match per row), all rows of df belong to the same block as candidates
+    reduced to the distinct scores in ascending order and the first candidate row with each, independent of the cutoff
+    returns a list with one (scores, rows) pair of arrays per row of df, see rank_matches
+    '''
+    queries = df[col].to_numpy(dtype=object)
+    values = candidates[col_choices].to_numpy(dtype=object)
+    # same entries as in get_match
+    valid = np.array([[v is not np.nan for v in row] for row in values], dtype=bool).reshape(values.shape)
+    is_str = np.vectorize(lambda v: isinstance(v, str), otypes=[bool])(values)
+    str_query = np.array([isinstance(q, str) for q in queries], dtype=bool)
+
+    # rows with non-string entries, or non-string queries, are scored as in get_match
+    batch_rows = (is_str | ~valid).all(axis=1)
+    row_scores = np.full((len(queries), len(candidates)), -1)
+    rows, cols = np.nonzero(valid & batch_rows[:, None])
+    if str_query.any() & (rows.size > 0):
+        scores = score_matrix(queries[str_query], values[rows, cols], method)
+        # best entry per candidate row
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        row_scores[np.ix_(str_query, rows[starts])] = np.maximum.reduceat(scores, starts, axis=1)
+    for q, r in zip(*np.nonzero(~str_query[:, None] | ~batch_rows[None, :])):
+        row_pos = [v for v, ok in zip(values[r], valid[r]) if ok]
+        try: match_row = process.extractOne(queries[q], row_pos, score_cutoff=0, scorer = method)
+        except: continue
+        if match_row is not None:
+            row_scores[q, r] = match_row[1]
+
+    # sort the rows of each query by score (stable: the first row first), keep the first of each score
+    order = np.argsort(row_scores, axis=1, kind='stable')
+    ranked = np.take_along_axis(row_scores, order, axis=1)
+    keep = (ranked >= 0) & np.c_[np.ones((len(ranked), 1), dtype=bool), ranked[:, 1:] != ranked[:, :-1]]
+    q, k = np.nonzero(keep)
+    scores, rows = ranked[q, k], order[q, k]
+    bounds = np.searchsorted(q, np.arange(len(ranked) + 1))
+    return [(scores[a:b], rows[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+def rank_matches(df, candidates, ranks, cutoff = 80):
+    '''
+    matches of the rows of df with candidates from their block_ranks: the first row with the lowest score >= cutoff
+    as in get_match, the first entry of ranks >= cutoff
+    returns a list with one entry (dictionary or None) per row of df
+    '''
+    # index labels as python objects, the same as get_match returns (not numpy integers)
+    survey_labels, pp_labels = candidates.index.tolist(), df.index.tolist()
+    matches = []
+    for pp_i, (scores, rows) in zip(pp_labels, ranks):
+        k = np.searchsorted(scores, cutoff)
+        if k == len(scores):
+            matches.append(None)
+        else:
+            matches.append({'survey_i':survey_labels[rows[k]], 'pp_i':pp_i, 'score':int(scores[k])})
+    return matches
+
+def nan_cells(candidates, col_choices):
+    '''
+    position of the np.nan objects in the object columns of candidates[col_choices]
+    get_match drops entries that are np.nan by identity, which does not survive pickling
+    '''
+    return {c: np.array([v is np.nan for v in candidates[c]], dtype=bool) for c in col_choices if candidates[c].dtype == object}
+
+def match_blocks(tasks, col, col_choices, common = 'transno', cutoff = 80, method = fuzz.ratio, by_county = False):
+    '''
+    matches for a list of (rows of df, candidates) pairs of the same block
+    tasks sent to other processes also contain nan_cells(candidates, col_choices)
+    returns a list of (index in df, match, ranks), ranks as in block_ranks
+     (for scorers not batched only the match, which depends on the cutoff)
+    '''
+    out = []
+    for df_block, candidates, *nans in tasks:
+        # put back np.nan after pickling
+        if len(nans) > 0:
+            candidates = candidates.copy()
+            for c, cells in nans[0].items():
+                values = candidates[c].to_numpy(dtype=object, copy=True)
+                values[cells] = np.nan
+                candidates[c] = values
+        if batched(method):
+            ranks = block_ranks(df_block, col, candidates, col_choices, method)
+            matches = rank_matches(df_block, candidates, ranks, cutoff)
+        else:
+            blocks = block_index(candidates, common, by_county)
+            matches = [get_match(r, col, candidates, col_choices, common, cutoff, method, blocks, by_county) for _, r in df_block.iterrows()]
+            # the match as the only score
+            none = (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+            ranks = [none if m is None else (np.array([m['score']]), np.array([candidates.index.get_loc(m['survey_i'])])) for m in matches]
+        out.extend(zip(df_block.index, matches, ranks))
+    return out
+
+def shard_blocks(tasks, n):
+    '''
+    split (rows of df, candidates) pairs into n lists of similar work (number of pairs to score)
+    largest blocks first, each to the currently smallest list
+    '''
+    shards = [[] for _ in range(n)]
+    load = [(0, s) for s in range(n)]
+    for t in sorted(tasks, key=lambda t: len(t[0])*len(t[1]), reverse=True):
+        size, s = heapq.heappop(load)
+        shards[s].append(t)
+        heapq.heappush(load, (size + len(t[0])*len(t[1]), s))
+    return [s for s in shards if len(s) > 0]
+
+def exact_matches(df1, df2, df1_col, df2_cols, common = 'transno', by_county = False, method = fuzz.ratio):
+    '''
+    pairs of rows with the same processed string in df1[df1_col] and one of df2[df2_cols] (score 100)
+    within the same common (and county), found by a join instead of scoring
+    returns a dataframe with columns pp_i (index in df1) and survey_i (index in df2), the first row of df2 for each row of df1
+    '''
+    keys = [common, 'county'] if by_county else [common]
+    force_ascii = SCORERS[method][1]
+    # entries of df2 in long format, in the order of the rows
+    values = df2[df2_cols].to_numpy(dtype=object)
+    rows, cols = np.nonzero(np.vectorize(lambda v: isinstance(v, str), otypes=[bool])(values).reshape(values.shape))
+    right = pd.DataFrame({k: df2[k].to_numpy(dtype=object)[rows] for k in keys})
+    right['value'] = process_strings(values[rows, cols], force_ascii)
+    right['survey_pos'] = rows
+    left = df1[df1[df1_col].map(lambda v: isinstance(v, str))]
+    left = pd.DataFrame({'pp_i': left.index, 'value': process_strings(left[df1_col], force_ascii), **{k: left[k].to_numpy(dtype=object) for k in keys}})
+    # empty strings are no informative match
+    join = left[left['value'] != ''].merge(right, on = keys + ['value'])
+    join = join.sort_values(['survey_pos'], kind='stable').drop_duplicates('pp_i')
+    return pd.DataFrame({'pp_i': join['pp_i'].to_numpy(), 'survey_i': df2.index[join['survey_pos']]})
+
+def match_and_merge(df1, df2, newcol, df1_col, df2_cols, common = 'transno', cutoff = 80, fuzzy = fuzz.ratio, by_county = False, workers = 1, exact = None, store = None):
+    '''
+    matches values based on function get_match and merges them
+    adds the columns {newcol}_survey_i (index in df2) and {newcol}_score to df1 (missing without match)
+    returns the matched rows of df2 and df1 with the column match_pass = newcol
+    by_county: restrict candidates to the same county in addition to common
+    batched scorers are computed block by block (block_ranks, rank_matches), others row by row
+    workers: number of processes, blocks are distributed with shard_blocks
+    exact: output of exact_matches, these rows get a score of 100 and are removed from both sides before the fuzzy matching
+    store: path of a match_store, only rows whose value or block changed since the last run are scored,
+     the stored scores of batched scorers do not depend on the cutoff (a rerun with another cutoff scores nothing)
+    '''
+    # get the matches for all blocks
+    matches = {}
+    df1_fuzzy, df2_fuzzy = df1, df2
+    if exact is not None:
+        for pp_i, survey_i in zip(exact['pp_i'].tolist(), exact['survey_i'].tolist()):
+            matches[pp_i] = {'survey_i':survey_i, 'pp_i':pp_i, 'score':100}
+        df1_fuzzy, df2_fuzzy = df1.drop(exact['pp_i']), df2.drop(exact['survey_i'].unique())
+    # group candidates once
+    blocks = block_index(df2_fuzzy, common, by_county)
+    keys = [common, 'county'] if by_county else common
+    tasks = [(df_block, blocks[key]) for key, df_block in df1_fuzzy.groupby(keys, sort = False, observed = True) if key in blocks]
+    args = (df1_col, df2_cols, common, cutoff, fuzzy, by_county)
+    if store is not None:
+        con = match_store.connect(store)
+        # the ranks of block_ranks are the same for every cutoff, the matches of get_match are not;
+        # fuzzywuzzy scores differently without python-Levenshtein
+        params = match_store.params_key(df1_col, df2_cols, common, fuzzy, by_county, LEVENSHTEIN, *([] if batched(fuzzy) else [cutoff]))
+        found, tasks, block_keys = match_store.split(con, params, tasks, df1_col, [common, 'county'] + df2_cols)
+        for df_block, candidates, ranks in found:
+            matches.update(zip(df_block.index, rank_matches(df_block, candidates, ranks, cutoff)))
+    results = []
+    if (workers > 1) & (len(tasks) > 1):
+        shards = shard_blocks([(d, c, nan_cells(c, df2_cols)) for d, c in tasks], workers)
+        with ProcessPoolExecutor(len(shards), mp_context=mp_context()) as ex:
+            for result in ex.map(match_blocks, shards, *[[a]*len(shards) for a in args]):
+                results.extend(result)
+    else:
+        results = match_blocks(tasks, *args)
+    matches.update((i, m) for i, m, _ in results)
+    if store is not None:
+        match_store.save(con, params, tasks, block_keys, {i: r for i, _, r in results}, df1_col)
+        con.close()
+    # define new columns in the order of df1: index in df2 and score, missing if no match
+    found = [matches.get(i) for i in df1.index]
+    df1[f'{newcol}_survey_i'] = pd.array([m['survey_i'] if m is not None else None for m in found], dtype='Int64')
+    df1[f'{newcol}_score'] = pd.array([m['score'] if m is not None else None for m in found], dtype='UInt8')
+
+    # remove non informative entries
+    df1_clean = df1[df1[f'{newcol}_score'].notna()]
+
+    # perform inner merge of dataframes
+    merge = df2.merge(df1_clean, how='inner',left_on=['county','transno',df2.index.values], right_on = ['county','transno',f'{newcol}_survey_i'])
+    # pass that found the match
+    merge['match_pass'] = newcol
+
+    # return the merged data
+    return merge
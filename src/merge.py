@@ -1,364 +1,339 @@
 '''
 merge post- and prepaid data with survey
- 
+
  fuzzy matching
+
+ python merge.py [--data ../data] [--workers 4] [--no-store]
+ or from python: merge.run(data)
 '''
 
-from sys import displayhook
 import pandas as pd
 #pd.set_option('max_columns', None)
-from zipfile import ZipFile
 from pathlib import Path
 import re
-import numpy as np
+import os
+import argparse
 #import difflib
 
-from fuzzywuzzy import process, fuzz
-# avoid warning
-import logging
-logging.getLogger().setLevel(logging.ERROR)
+from loader import read_member, member_key, cached
+import normalize
+from schema import PREPOST, concat
+from instrument import stage, write_report
 
-########################
-# FUNCTIONS
-#######################  
+wd = Path.cwd()
 
-def get_match(df, col, df_choices, col_choices, common, cutoff = 80, method = fuzz.ratio):
-    '''
-    get best match for each entry in df[col]
-    common: column which needs to be the same for both dataframes (transno)
-    cutoff: minimum similarity
-    method: get more info here: https://pypi.org/project/fuzzywuzzy/
-    '''
-    # initialize dictionary
-    matches = {}
-    # loop through rows in df_choices
-    for i,r in df_choices[df_choices[common] == df[common]].iterrows():
-        # extract entries from col_choices
-        row_pos = [r[c] for c in col_choices if r[c] is not np.nan]
-        # find the best match among col_choices
-        try: match_row = process.extractOne(df[col],row_pos,score_cutoff=cutoff,scorer = method)
-        except: continue
-        # add to dictionary
-        if match_row is not None: 
-            matches[i] = match_row[1] 
-    # find the best match among all rows        
-    if len(matches) >0:
-        matches_sorted = dict(sorted(matches.items(), key=lambda x:x[1]))
-        max_match = (list(matches_sorted.keys())[0], list(matches_sorted.values())[0])
-        # return best match (index in df_choices, similarity score)
-        dct= {'survey_i':max_match[0], 'pp_i':df.name, 'score':max_match[1]}
-        return dct
-
-def match_and_merge(df1, df2, newcol, df1_col, df2_cols, common = 'transno', cutoff = 80, fuzzy = fuzz.ratio):
-    '''
-    matches values based on function get_match and merges them
-    '''    
-    # define new column and apply get_match
-    df1[newcol] = df1.apply(get_match, args = (df1_col, df2, df2_cols, common, cutoff, fuzzy), axis = 1)
-
-    # extract the index
-    df1[f'{newcol}_index'] = df1[newcol].apply(lambda row: row['survey_i'] if row is not None else np.nan)
-
-    # remove non informative entries
-    df1_clean = df1[df1[newcol].notnull() & (df1[newcol] != '')]
-
-    # perform inner merge of dataframes
-    merge = df2.merge(df1_clean, how='inner',left_on=['county','transno',df2.index.values], right_on = ['county','transno',f'{newcol}_index'])
-    
-    # drop index columns
-    merge = merge.drop([f'{newcol}_index'], axis=1)
-    df1 = df1.drop([f'{newcol}_index'], axis=1, inplace=True)
-    # return the merged data
-    return merge 
+# relevant columns
+pp_cols = ['COUNTY','TXNUMBER','TRANSNO','FULL_NAME','SERIAL_NUM','ACCOUNT_NO','OFFERED_SERVICE']
+survey_cols = ['county', 'transno','transname', 'a1_7','a3_15','a3_22','hh_member1','hh_member2', 'hh_member3', 'hh_member4', 'hh_member5','hh_member6','hh_member7','hh_member8','hh_member9','hh_member10','hh_member11','hh_member12','hh_member13','hh_member14','hh_member15', 'l1_1','l1_2','lmcp']
+names_list = ['a3_15','a3_22','hh_member1','hh_member2', 'hh_member3', 'hh_member4', 'hh_member5','hh_member6','hh_member7','hh_member8','hh_member9','hh_member10','hh_member11','hh_member12','hh_member13','hh_member14','hh_member15']
+pp_members = ['Postpaid_AFDB_TX_Data_20220126.txt', 'Prepaid_AFDB_TX_Data_20220126.txt']
 
 ########################
 # DATA
 #######################
-wd = Path.cwd()
 
-zip = ZipFile(wd.parent/'data'/'post_pre_paid.zip')
-
-post = pd.read_csv(zip.open('Postpaid_AFDB_TX_Data_20220126.txt'), sep = '|', dtype={'SERIAL_NUM': str, 'ACCOUNT_NO':str})
-# load serial_num and account_num as strings for better handling
-pre = pd.read_csv(zip.open('Prepaid_AFDB_TX_Data_20220126.txt'), sep = '|',dtype={'SERIAL_NUM': str, 'ACCOUNT_NO':str})
-
-zip_survey = ZipFile(wd.parent/'data'/'survey.zip')
+def load(data):
+    '''
+    post- and prepaid data and survey in the folder data
+    parsed files are cached in data/cache (see loader.py)
+    '''
+    with stage('load') as st:
+        # load serial_num and account_num as strings for better handling
+        post, pre = [read_member(data/'post_pre_paid.zip', m, columns = pp_cols, schema = PREPOST, sep = '|', dtype={'SERIAL_NUM': str, 'ACCOUNT_NO':str}) for m in pp_members]
 
-survey = pd.read_stata(zip_survey.open('survey/workingsample8.dta'))
+        survey = read_member(data/'survey.zip', 'survey/workingsample8.dta', columns = survey_cols)
+        st.rows_out = len(post) + len(pre) + len(survey)
+    return post, pre, survey
 
 ########################
 # PREPARE survey
 #########################
 
-# keep relevant columns
-survey = survey[['county', 'transno','transname', 'a1_7','a3_15','a3_22','hh_member1','hh_member2', 'hh_member3', 'hh_member4', 'hh_member5','hh_member6','hh_member7','hh_member8','hh_member9','hh_member10','hh_member11','hh_member12','hh_member13','hh_member14','hh_member15', 'l1_1','l1_2','lmcp']]
-
-# define treatment if xx in HH_xx > 32
-survey['treatment'] = survey['a1_7'].apply(lambda row: 1 if int(re.sub(r'\D','',row)) < 32 else 0)
-
-
-# a3_15 - name of respondent
-# a3_22 - name of hh head
-
-# extract numbers # meternumber # accountnumber
-numbers = ['l1_1','l1_2']
-survey[numbers] = survey[numbers].replace('', np.nan)
-survey[numbers] = survey[numbers].replace('0', np.nan)
-survey[numbers] = survey[numbers].replace(regex= '[\s_-]+', value = np.nan)
-#survey[numbers] = survey[numbers].replace(regex= '\d+(\d+)', value = np.nan)
-
-survey[numbers] = survey[numbers].apply(lambda row: re.match('([\d]*)\D',row) if not np.nan else row)
-survey[numbers] = survey[numbers].replace(regex = r'[aA-zZ]', value = np.nan)
-
+def prepare_survey(survey, data):
+    '''
+    treatment, normalized meter and account numbers, names, transno and county (see normalize.py)
+    the normalized survey is cached in data/cache together with the raw data
+    '''
+    with stage('prepare survey', rows_in = len(survey)) as st:
+        # keep relevant columns
+        survey = survey[survey_cols]
 
-survey['county'] = survey['county'].str.lower()
+        # define treatment if xx in HH_xx > 32
+        survey['treatment'] = survey['a1_7'].apply(lambda row: 1 if int(re.sub(r'\D','',row)) < 32 else 0)
 
-survey['a3_15'] = survey['a3_15'].str.casefold()
-# remove leading and trailing spaces
-survey['a3_15'] = survey['a3_15'].replace(regex=r"^\s+|\s+$", value = '')
-# remove duplicated space
-survey['a3_15'] = survey['a3_15'].replace(regex=r" +", value = ' ')
+        # a3_15 - name of respondent
+        # a3_22 - name of hh head
 
-# transno
-survey['transno'] = survey['transno'].str.casefold()
-survey['transno'] = survey['transno'].replace(regex=r',',value=' ')
-survey['transno'] = survey['transno'].replace(regex=r"^\s+|\s+$", value = '')
-survey['transno'] = survey['transno'].replace(regex=r" +", value = ' ')
+        survey_cache_key = (member_key(data/'survey.zip', 'survey/workingsample8.dta'), survey_cols, normalize.VERSION)
+        survey = cached('survey_normalized', survey_cache_key, lambda: normalize.normalize_survey(survey), data/'cache')
+        st.rows_out = len(survey)
+    return survey
 
 ########################
 # PREPARE pre-post
 #########################
 
-# merge pre and post data, drop duplicates
-pp = post.append(pre).reset_index(drop=True)
-
-# select relevant columns
-pp = pp[['COUNTY','TXNUMBER','TRANSNO','FULL_NAME','SERIAL_NUM','ACCOUNT_NO','OFFERED_SERVICE']].drop_duplicates().reset_index(drop=True)
-
-pp.columns = pp.columns.str.lower()
-
-# remove non informative entries
-pp = pp.dropna(subset=['full_name','serial_num','account_no'])
-
-# remove leading and trailing spaces
-pp['serial_num'] = pp['serial_num'].replace(regex=r"^\s+|\s+$", value = '')
-pp['account_no'] = pp['account_no'].replace(regex=r"^\s+|\s+$", value = '')
-
-pp['county'] = pp['county'].str.lower()
-
-pp['full_name'] = pp['full_name'].str.casefold()
-# remove leading and trailing spaces
-pp['full_name'] = pp['full_name'].replace(regex=r"^\s+|\s+$", value = '')
-# remove duplicated space
-pp['full_name'] = pp['full_name'].replace(regex=r" +", value = ' ')
+def prepare_pp(post, pre, survey, data):
+    '''
+    pre- and postpaid records without duplicates, normalized serial and account number, name, transno and county
+    cached like the survey
+    '''
+    with stage('prepare pre-post', rows_in = len(post) + len(pre)) as st:
+        # merge pre and post data, drop duplicates
+        pp = concat([post, pre]).reset_index(drop=True)
 
-# transno
-pp['transno'] = pp['transno'].str.casefold()
-pp['transno'] = pp['transno'].replace(regex=r',',value=' ')
-pp['transno'] = pp['transno'].replace(regex=r"^\s+|\s+$", value = '')
-pp['transno'] = pp['transno'].replace(regex=r" +", value = ' ')
+        # select relevant columns
+        pp = pp[pp_cols].drop_duplicates().reset_index(drop=True)
 
+        pp.columns = pp.columns.str.lower()
 
-# check if all transformers in pp exist in survey
-##set(survey.transno).intersection(set(pp.transno))
-pp['survey_trans'] = pp['transno'].apply(lambda row: 1 if row in set(survey.transno) else 0)
-#print(pp[pp.survey_trans == 0]) 
-#print(survey[survey.transno == '41755 kwini market'])
+        # numbers are edited as strings below, not as category
+        pp = pp.astype({'serial_num':object, 'account_no':object})
 
-# !!! I assume that 'kwni market' = '41755 kwini market'
-pp.loc[pp.transno == 'kwni market','transno'] =  '41755 kwini market'
-pp['survey_trans'] = pp['transno'].apply(lambda row: 1 if row in set(survey.transno) else 0)
-#print('should be an empty dataframe:\n')
-#print(pp[pp.survey_trans == 0]) 
+        # remove non informative entries
+        pp = pp.dropna(subset=['full_name','serial_num','account_no'])
 
-pp = pp.drop('survey_trans', axis=1)
+        pp_cache_key = ([member_key(data/'post_pre_paid.zip', m) for m in pp_members], pp_cols, normalize.VERSION)
+        pp = cached('pp_normalized', pp_cache_key, lambda: normalize.normalize_pp(pp), data/'cache')
 
+        # check if all transformers in pp exist in survey
+        #survey_trans = pp['transno'].isin(set(survey.transno))
+        #print(pp[~survey_trans])
+        #print(survey[survey.transno == '41755 kwini market'])
 
-'''
--> this allows to use the column 'transno' for matching
-'''
+        # !!! I assume that 'kwni market' = '41755 kwini market'
+        pp.loc[pp.transno == 'kwni market','transno'] =  '41755 kwini market'
+        #print('should be an empty dataframe:\n')
+        #print(pp[~pp['transno'].isin(set(survey.transno))])
+        st.rows_out = len(pp)
 
+    '''
+    -> this allows to use the column 'transno' for matching
+    '''
+    return pp
 
 ########################
 # MERGE based on name, serial- and account number
 #########################
 
-# how to choose algorithm : https://pypi.org/project/fuzzywuzzy/
-
-
-###################  merge on serial number ###################
-#  df with merges on serial number
-merge_serial = match_and_merge(pp, survey, newcol = 'closest_serial',df1_col = 'serial_num',df2_cols=['l1_1','l1_2'],cutoff = 65, fuzzy=fuzz.ratio)
-
-'''
-1.	If there is a 100 score match based on the meter (serial) number, remove that TX observation from the list of possible matches to reduce duplicate matches
-'''
-
-# list of rows in survey that got matched by serial_num at a score of minimum 
-min_score = 100
+def match(pp, survey, workers = None, store = None):
+    '''
+    match pp with the survey on serial number, then account number, then names
+    returns the matches of the three passes
+    workers: number of processes for the matching passes, blocks of transno are split among them (default: all cpus)
+    store: matches of earlier runs, only new or changed records and blocks are scored again (see match_store.py)
+    '''
+    # how to choose algorithm : https://pypi.org/project/fuzzywuzzy/
+    from fuzzywuzzy import fuzz
+    from matching import match_and_merge, exact_matches
+    if workers is None:
+        workers = os.cpu_count()
 
-lst_survey_merged = merge_serial['closest_serial'].apply(lambda row: row['survey_i'] if row['score'] >= min_score else None).dropna().tolist()
-lst_pp_merged = merge_serial['closest_serial'].apply(lambda row: row['pp_i'] if row['score'] >= min_score else None).dropna().tolist()
+    ###################  merge on serial number ###################
+    with stage('match serial number', rows_in = len(pp)) as st:
+        # exact matches of serial number are found by a join, only the remaining rows are fuzzy matched
+        exact_serial = exact_matches(pp, survey, 'serial_num', ['l1_1','l1_2'])
 
+        #  df with merges on serial number
+        merge_serial = match_and_merge(pp, survey, newcol = 'closest_serial',df1_col = 'serial_num',df2_cols=['l1_1','l1_2'],cutoff = 65, fuzzy=fuzz.ratio, workers=workers, store=store, exact=exact_serial)
+        st.rows_out = len(merge_serial)
 
-###################  merge on account number ###################
-# df with merges on account number that are not already merged before
-df_input = survey.drop(lst_survey_merged)
-pp_input = pp.loc[~pp.index.isin(lst_pp_merged)]
+    '''
+    1.	If there is a 100 score match based on the meter (serial) number, remove that TX observation from the list of possible matches to reduce duplicate matches
+    '''
 
-merge_account = match_and_merge(pp_input, df_input, newcol = 'closest_account',df1_col = 'account_no',df2_cols=['l1_1','l1_2'], cutoff = 65, fuzzy=fuzz.ratio)
+    # list of rows in survey that got matched by serial_num at a score of 100 (exact matches)
+    lst_survey_merged = exact_serial['survey_i'].tolist()
+    lst_pp_merged = exact_serial['pp_i'].tolist()
 
-# get rows that are merged having at least minimum score
-lst_survey_merged_acc = merge_account['closest_account'].apply(lambda row: row['survey_i'] if row['score'] >= min_score else None).dropna().tolist()
-lst_survey_merged_acc.extend(lst_survey_merged)
+    ###################  merge on account number ###################
+    with stage('match account number', rows_in = len(pp) - len(lst_pp_merged)) as st:
+        # df with merges on account number that are not already merged before
+        df_input = survey.drop(lst_survey_merged)
+        pp_input = pp.loc[~pp.index.isin(lst_pp_merged)]
 
-lst_pp_merged_acc = merge_account['closest_account'].apply(lambda row: row['pp_i'] if row['score'] >= min_score else None).dropna().tolist()
-lst_pp_merged_acc.extend(lst_pp_merged)
+        exact_account = exact_matches(pp_input, df_input, 'account_no', ['l1_1','l1_2'])
+        merge_account = match_and_merge(pp_input, df_input, newcol = 'closest_account',df1_col = 'account_no',df2_cols=['l1_1','l1_2'], cutoff = 65, fuzzy=fuzz.ratio, workers=workers, store=store, exact=exact_account)
+        st.rows_out = len(merge_account)
 
-###################  merge on names ###################
+    # get rows that are merged with a score of 100
+    lst_survey_merged_acc = exact_account['survey_i'].tolist()
+    lst_survey_merged_acc.extend(lst_survey_merged)
 
-# df with merges on name that are not already merged before
-names_list = ['a3_15','a3_22','hh_member1','hh_member2', 'hh_member3', 'hh_member4', 'hh_member5','hh_member6','hh_member7','hh_member8','hh_member9','hh_member10','hh_member11','hh_member12','hh_member13','hh_member14','hh_member15']
+    lst_pp_merged_acc = exact_account['pp_i'].tolist()
+    lst_pp_merged_acc.extend(lst_pp_merged)
 
-df_input = survey.drop(lst_survey_merged_acc)
-pp_input = pp.loc[~pp.index.isin(lst_pp_merged_acc)]
+    ###################  merge on names ###################
+    with stage('match names', rows_in = len(pp) - len(lst_pp_merged_acc)) as st:
+        # df with merges on name that are not already merged before
+        df_input = survey.drop(lst_survey_merged_acc)
+        pp_input = pp.loc[~pp.index.isin(lst_pp_merged_acc)]
 
-merge_name = match_and_merge(pp_input, df_input, newcol = 'closest_name',df1_col = 'full_name',df2_cols=names_list,cutoff = 70, fuzzy=fuzz.token_set_ratio)
+        merge_name = match_and_merge(pp_input, df_input, newcol = 'closest_name',df1_col = 'full_name',df2_cols=names_list,cutoff = 70, fuzzy=fuzz.token_set_ratio, workers=workers, store=store)
+        st.rows_out = len(merge_name)
 
-################### concat all merged data  ###################
-merged = pd.concat([merge_serial, merge_account, merge_name])
+    ################### concat all merged data  ###################
+    with stage('concat'):
+        merged = pd.concat([merge_serial, merge_account, merge_name])
+        merged['match_pass'] = merged['match_pass'].astype('category')
+    return merged
 
 
 '''
-2.	For serial number matched at a high score that is not 100 (e.g.  90<=score<100) , let’s also check what the matching score is for the names of the SAME matched observation. If that is high enough (e.g. score>=75) OR there is any overlap in the name, then we declare this as a good match. 
+2.	For serial number matched at a high score that is not 100 (e.g.  90<=score<100) , let’s also check what the matching score is for the names of the SAME matched observation. If that is high enough (e.g. score>=75) OR there is any overlap in the name, then we declare this as a good match.
 '''
 def good_match(df, cols, ser_min = 90, name_min = 75):
     '''
     declare good matches
+    returns True if score serial = 100, or score serial between 90-100 and score name >= 75 for the same survey row
     '''
-    # if score serial = 100
-    if (df[cols[0]] not in [None, np.nan]):
-        if (df[cols[0]]['score'] == 100):
-            return True
-    # if score serial between 90-100 and score name > 75
-        elif (df[cols[1]] not in [None, np.nan]):
-            # check if same match
-            same_survey = df[cols[0]]['survey_i'] == df[cols[1]]['survey_i']
-            same_pp = df[cols[0]]['pp_i'] == df[cols[1]]['pp_i']
-            # check serial score
-            score_ser = (df[cols[0]]['score'] >= ser_min) & (df[cols[0]]['score'] < 100)
-            # check name score
-            score_name = df[cols[1]]['score'] >= name_min
-            # if all True
-            bool = same_survey + same_pp + score_name + score_ser == 4
-            return bool
-        else: return False
-    else: return False
-
-
-
-merged['good_match'] = merged.apply(lambda row: good_match(row, ['closest_serial', 'closest_name']), axis = 1)
-
+    ser, name = df[f'{cols[0]}_score'], df[f'{cols[1]}_score']
+    # check if same match
+    same_survey = df[f'{cols[0]}_survey_i'] == df[f'{cols[1]}_survey_i']
+    good = (ser == 100) | (same_survey & (ser >= ser_min) & (ser < 100) & (name >= name_min))
+    # missing scores (no match) are not good
+    return good.fillna(False).astype(bool)
 
 '''
 3.	We still have some duplicate matches where one of the matches has a higher score, are we not keeping the matches with the highest score among duplicates  and dropping the rest?
 '''
-
-# get the highest score among, serial, account and name matches
-def highest_score(df, cols):
-    list = [x['score'] for x in df[cols] if (x is not np.nan) & (x is not None)]
-    return max(list)
-
-merged['highest_score'] = merged.apply(lambda row: highest_score(row,['closest_serial','closest_account','closest_name']), axis=1)
-
-def highest_dup(df, cols = survey.columns.tolist()):
+def highest_dup(df, score, key = 'survey_key'):
     '''
     when duplicates keep only the ones with highest score
+    returns True if row has the highest score among the rows with the same key
+    '''
+    return df[score] >= df.groupby(key)[score].transform('max')
+
+def dedup(merged, survey):
+    '''
+    keep the good matches and the best match of each survey observation
     '''
-    # get all rows
-    bool = merged[cols].isin(df[cols].values.ravel()).all(axis=1)
-    # maximum score in group
-    max_dup_score = merged.loc[bool, 'highest_score'].max()
-    # return True if row has highest score or is declared as good match
-    yes = (df['highest_score'] >= max_dup_score) or df['good_match'] 
-    return yes
+    from fuzzywuzzy import process, fuzz
+    from matching import batched, best_scores
 
-high_dups = merged.apply(lambda row: highest_dup(row), axis=1)
+    with stage('good match'):
+        merged['good_match'] = good_match(merged, ['closest_serial', 'closest_name'])
 
-merged = merged[high_dups]
+    with stage('highest score'):
+        # get the highest score among, serial, account and name matches
+        merged['highest_score'] = merged[['closest_serial_score','closest_account_score','closest_name_score']].max(axis=1).astype('uint8')
 
+        # one key per survey observation, duplicate matches share the same key
+        merged['survey_key'] = pd.util.hash_pandas_object(merged[survey.columns], index=False).values
 
-#############################
+    with stage('highest_dup', rows_in = len(merged)) as st:
+        # keep rows with highest score or declared as good match
+        merged = merged[highest_dup(merged, 'highest_score') | merged['good_match']]
+        st.rows_out = len(merged)
 
-# problem: some entries seem to be from the same person but different account or serial numbers or missing
-# solution: put them in a list in a new column
+    #############################
 
-identifier = survey.columns.tolist()
-identifier.extend(['full_name', 'offered_service'])
+    # problem: some entries seem to be from the same person but different account or serial numbers or missing
+    # solution: put them in a list in a new column
 
-dups_serial = merged.groupby(identifier)['serial_num'].apply(list).reset_index().rename(columns ={'serial_num':'serial_list'})
+    with stage('duplicate numbers', rows_in = len(merged)) as st:
+        identifier = survey.columns.tolist()
+        identifier.extend(['full_name', 'offered_service'])
 
-merged = merged.merge(dups_serial, how ='left', on=identifier)
+        dups_serial = merged.groupby(identifier, observed=True)['serial_num'].apply(list).reset_index().rename(columns ={'serial_num':'serial_list'})
 
-dups_account =  merged.groupby(identifier)['account_no'].apply(list).reset_index().rename(columns ={'account_no':'account_list'})
+        merged = merged.merge(dups_serial, how ='left', on=identifier)
 
-merged = merged.merge(dups_account, how ='left', on=identifier)
+        dups_account =  merged.groupby(identifier, observed=True)['account_no'].apply(list).reset_index().rename(columns ={'account_no':'account_list'})
 
-merged = merged.drop_duplicates(subset = identifier)
+        merged = merged.merge(dups_account, how ='left', on=identifier)
 
+        merged = merged.drop_duplicates(subset = identifier)
+        st.rows_out = len(merged)
 
+    '''
+    in the remaining duplicates, perform a name matching based on a different algorithm
+    '''
 
-'''
-in the remaining duplicates, perform a name matching based on a different algorithm
-'''
+    # list of names columns in survey: names_list
 
-# list of names columns in survey: names_list
+    with stage('name match score', rows_in = len(merged)) as st:
+        algo_match = fuzz.token_sort_ratio # fuzz.partial_ratio for partial matches
+        strings = merged[['full_name'] + names_list].applymap(lambda v: isinstance(v, str)).all(axis=None)
+        if batched(algo_match) & strings:
+            # all pairs in one batch, same scores as extractOne
+            merged['name_match_score'] = best_scores(merged['full_name'].to_numpy(dtype=object), merged[names_list].to_numpy(dtype=object), algo_match)
+        else:
+            merged['name_match_score'] = merged.apply(lambda row: process.extractOne(row.full_name, row[names_list], scorer=algo_match)[1] , axis=1)
 
-algo_match = fuzz.token_sort_ratio # fuzz.partial_ratio for partial matches
-merged['name_match_score'] = merged.apply(lambda row: process.extractOne(row.full_name, row[names_list], scorer=algo_match)[1] , axis=1)
+        # keep those with highest match among duplicates
+        merged = merged[highest_dup(merged, 'name_match_score')]
+        merged = merged.drop(columns = 'survey_key')
+        st.rows_out = len(merged)
+    return merged
 
-# keep duplicates with highes match
-def dups_name_match(df, cols = survey.columns.tolist()):
-    '''
-    when duplicates keep only the ones with highest name_match_score
-    '''
-    # get all rows
-    bool = merged[cols].isin(df[cols].values.ravel()).all(axis=1)
-    # maximum score in group
-    max_dup_score = merged.loc[bool, 'name_match_score'].max()
-    # return True if row has highest score 
-    bool = (df['name_match_score'] >= max_dup_score) 
-    return bool
-    
-# boolean serios
-dups_highest_name = merged.apply(lambda row: dups_name_match(row), axis=1)
-
-# keep those with highest match among duplicates
-merged = merged[dups_highest_name]
-
-# save as csv
-merged.to_csv(wd.parent/'data'/'survey_prepost_matched.csv', index=False)
 ###############################
 '''
 4.	After doing step 3 above, can we have some summary stats: what proportion of the matches has a score of 100 based on serial id (I think it was about 850 observations)? What proportion has a score above 90 but not equal to 100?
 '''
+def summary(merged):
+    '''
+    print the share of matches by score and the share of lmcp
+    '''
+    # you might restriction the matching of those who have a highest score above x
+    #merged = merged[merged['highest_score'] >= 85]
 
-# you might restriction the matching of those who have a highest score above x
-#merged = merged[merged['highest_score'] >= 85]
+    ser100 = (merged['closest_serial_score'] == 100).sum()
 
-ser100 = merged[merged['closest_serial'].apply(lambda row: row['score'] == 100 if row is not None else False)].shape[0]
+    ser90 = merged['closest_serial_score'].between(90, 99).sum()
 
-ser90 = merged[merged['closest_serial'].apply(lambda row: row['score'] in range(90,100) if row is not None else False)].shape[0]
+    print('Proportion score 100 based on serial number:', ser100/merged.shape[0])
 
-print('Proportion score 100 based on serial number:', ser100/merged.shape[0])
+    print('Proportion score 90-100 based on serial number:', ser90/merged.shape[0])
 
-print('Proportion score 90-100 based on serial number:', ser90/merged.shape[0])
+    print('Proportion score >= 90:', merged[merged.highest_score >=90].shape[0]/merged.shape[0])
 
-print('Proportion score >= 90:', merged[merged.highest_score >=90].shape[0]/merged.shape[0])
+    # get percentage of treatment in matching
+    print('percentage share of lmcp: \n')
+    print(merged.groupby(['lmcp'])['county'].count()/merged.shape[0],'\n')
 
-# get percentage of treatment in matching
-print('percentage share of lmcp: \n')
-print(merged.groupby(['lmcp'])['county'].count()/merged.shape[0],'\n')
+########################
+# RUN
+#######################
+
+def run(data = wd.parent/'data', workers = None, store = True):
+    '''
+    match the pre-/postpaid data in the folder data with the survey, write data/survey_prepost_matched.csv
+    store: reuse and keep the matches in data/cache/matches.sqlite
+    returns the matched data
+    '''
+    data = Path(data)
+    post, pre, survey = load(data)
+    survey = prepare_survey(survey, data)
+    pp = prepare_pp(post, pre, survey, data)
+    merged = match(pp, survey, workers = workers, store = data/'cache'/'matches.sqlite' if store else None)
+    merged = dedup(merged, survey)
+
+    # save as csv
+    with stage('write csv', rows_in = len(merged)):
+        merged.to_csv(data/'survey_prepost_matched.csv', index=False)
+    summary(merged)
+
+    # timings of the stages, if LMCP_PROFILE is set (see instrument.py)
+    write_report(data/'profile_merge.json')
+    return merged
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='match the pre-/postpaid data with the survey')
+    parser.add_argument('--data', default=wd.parent/'data', type=Path, help='folder with post_pre_paid.zip and survey.zip (default: ../data)')
+    parser.add_argument('--workers', type=int, default=None, help='processes for the matching passes (default: all cpus)')
+    parser.add_argument('--no-store', action='store_true', help='score everything again instead of reusing the stored matches')
+    args = parser.parse_args(argv)
+
+    # avoid warning
+    import logging
+    logging.getLogger().setLevel(logging.ERROR)
+
+    run(args.data, args.workers, not args.no_store)
+
+
+if __name__ == '__main__':
+    main()
 
 #####################################################
 
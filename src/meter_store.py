@@ -0,0 +1,217 @@
+'''
+per-meter time series of the consumption data as memory-mapped numpy arrays
+
+ built once by cons_data_processing.py --meter-store in data/meter_store:
+  meters.npy                    meter numbers, sorted
+  offsets.npy                   purchases of meter i are the rows offsets[i]:offsets[i+1] (CSR)
+  vending_date.npy, amount.npy, units.npy, debt_collected.npy, time_elapsed.npy
+                                one row per meter and vending date (transactions.collapse),
+                                sorted by meter and date, time_elapsed is NaT at the first purchase
+  county.npy, meterinstdate.npy one value per meter
+
+ while the data is read, the rows are split by meter into buckets in data/cache/meter_store
+ (collect), build() then collapses one bucket at a time and writes its rows into the
+ memory-mapped arrays at the place of their meters, only one bucket is held in memory
+
+ the arrays are opened with mmap_mode = 'r', a lookup only reads the pages of its meter:
+ a binary search in meters, then the slices, first and last date are taken at the offsets
+
+ store = MeterStore(data/'meter_store')
+ store.history('12345678901')     # purchases of the meter as dataframe
+ store.first_vending_date         # of all meters, without reading the purchases
+'''
+
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from transactions import collapse
+
+VERSION = 1
+# columns read from the consumption data
+columns = ['meternumber', 'vending_date', 'amount', 'units', 'debt_collected', 'county', 'meterinstdate']
+measures = ['amount', 'units', 'debt_collected']
+# parts the meters are split into while the data is read, build() holds one part in memory
+buckets = 64
+
+########################
+# BUILD
+#######################
+
+def prepare(df):
+    '''
+    columns of the store in df, typed, without rows missing meter or vending date
+    '''
+    df = df.reindex(columns = columns).dropna(subset = ['meternumber', 'vending_date'])
+    df['meternumber'] = df['meternumber'].astype(str)
+    df['county'] = df['county'].astype(str)
+    df['vending_date'] = pd.to_datetime(df['vending_date'])
+    df['meterinstdate'] = pd.to_datetime(df['meterinstdate'])
+    for m in measures:
+        df[m] = pd.to_numeric(df[m]).astype(np.float64)
+    return df
+
+def collect(chunks, spill, buckets = buckets):
+    '''
+    yield the chunks and write their columns of the store to the folder spill, split into buckets by meter
+    (all rows of a meter are in the same bucket)
+    '''
+    spill = Path(spill)
+    if spill.exists():
+        shutil.rmtree(spill)
+    for i, chunk in enumerate(chunks):
+        df = prepare(chunk)
+        bucket = pd.util.hash_array(df['meternumber'].to_numpy(dtype = object)) % buckets
+        for b, part in df.groupby(bucket, sort = False):
+            (spill/f'{b:03d}').mkdir(parents = True, exist_ok = True)
+            part.to_parquet(spill/f'{b:03d}'/f'part-{i:05d}.parquet', index = False)
+        yield chunk
+
+def build(spill, path):
+    '''
+    write the store of the buckets in the folder spill (collect) to the folder path, spill is removed
+    the buckets are collapsed one at a time and their rows written at the place of their meters in the sorted store
+    '''
+    spill, path = Path(spill), Path(path)
+    parts = sorted(p for p in spill.iterdir() if p.is_dir())
+    # collapse each bucket: its meters, their number of rows, county and meterinstdate
+    meters, counts, county, inst = [], [], [], []
+    for p in parts:
+        df = collapse(pd.read_parquet(p), ['meternumber', 'vending_date'], measures)
+        df.to_parquet(spill/f'{p.name}.parquet', index = False)
+        meter = df['meternumber'].to_numpy(dtype = str)
+        start = np.flatnonzero(np.r_[True, meter[1:] != meter[:-1]])
+        meters.append(meter[start])
+        counts.append(np.diff(np.r_[start, len(df)]))
+        county.append(df['county'].to_numpy(dtype = str)[start])
+        inst.append(df['meterinstdate'].to_numpy()[start])
+    meters, counts = np.concatenate(meters), np.concatenate(counts)
+    order = np.argsort(meters, kind = 'stable')
+    offsets = np.r_[0, np.cumsum(counts[order])].astype(np.int64)
+    # first row of each meter (in the order of the buckets) in the store
+    first = np.empty(len(meters), dtype = np.int64)
+    first[order] = offsets[:-1]
+
+    if path.exists():
+        shutil.rmtree(path)
+    path.mkdir(parents = True)
+    dtypes = {'vending_date': 'datetime64[ns]', 'time_elapsed': 'timedelta64[ns]', **{m: np.float64 for m in measures}}
+    rows = {c: np.lib.format.open_memmap(path/f'{c}.npy', mode = 'w+', dtype = d, shape = (int(offsets[-1]),)) for c, d in dtypes.items()}
+    # meters of the buckets before p
+    done = 0
+    for p in parts:
+        df = pd.read_parquet(spill/f'{p.name}.parquet')
+        meter = df['meternumber'].to_numpy(dtype = str)
+        start = np.flatnonzero(np.r_[True, meter[1:] != meter[:-1]])
+        size = np.diff(np.r_[start, len(df)])
+        # place of each row: first row of its meter in the store + position within the meter
+        dest = np.repeat(first[done:done + len(start)] - start, size) + np.arange(len(df))
+        date = df['vending_date'].to_numpy(dtype = 'datetime64[ns]')
+        elapsed = np.diff(date, prepend = date[:1])
+        elapsed[start] = np.timedelta64('NaT')
+        rows['vending_date'][dest] = date
+        rows['time_elapsed'][dest] = elapsed
+        for m in measures:
+            rows[m][dest] = df[m].to_numpy()
+        done += len(start)
+    for a in rows.values():
+        a.flush()
+    del rows
+
+    arrays = {'meters': meters[order], 'offsets': offsets, 'county': np.concatenate(county)[order], 'meterinstdate': np.concatenate(inst)[order]}
+    for name, a in arrays.items():
+        np.save(path/f'{name}.npy', a)
+    (path/'store.json').write_text(json.dumps({'version': VERSION, 'meters': len(meters), 'rows': int(offsets[-1])}))
+    shutil.rmtree(spill)
+
+########################
+# READ
+#######################
+
+class MeterStore:
+    '''
+    the arrays of the store in the folder path, memory-mapped
+    '''
+    def __init__(self, path):
+        path = Path(path)
+        info = json.loads((path/'store.json').read_text())
+        if info['version'] != VERSION:
+            raise ValueError(f'{path} has version {info["version"]}, rebuild it with cons_data_processing.py --meter-store')
+        self.path = path
+        self.meters = np.load(path/'meters.npy', mmap_mode = 'r')
+        self.offsets = np.load(path/'offsets.npy', mmap_mode = 'r')
+        self.rows = {c: np.load(path/f'{c}.npy', mmap_mode = 'r') for c in ['vending_date', 'time_elapsed'] + measures}
+        self.county = np.load(path/'county.npy', mmap_mode = 'r')
+        self.meterinstdate = np.load(path/'meterinstdate.npy', mmap_mode = 'r')
+
+    def __len__(self):
+        return len(self.meters)
+
+    def __contains__(self, meter):
+        i = np.searchsorted(self.meters, str(meter))
+        return (i < len(self.meters)) and (self.meters[i] == str(meter))
+
+    def index(self, meter):
+        '''
+        position of meter in meters (binary search), KeyError if it is not in the store
+        '''
+        if meter not in self:
+            raise KeyError(meter)
+        return int(np.searchsorted(self.meters, str(meter)))
+
+    def rows_of(self, meter):
+        '''
+        slice of the rows of meter
+        '''
+        i = self.index(meter)
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def history(self, meter):
+        '''
+        purchases of meter: vending date, amount, units, debt_collected and time since the last purchase
+        '''
+        rows = self.rows_of(meter)
+        return pd.DataFrame({c: np.asarray(a[rows]) for c, a in self.rows.items()})
+
+    def gaps(self, meter):
+        '''
+        time between the purchases of meter (without the NaT of the first purchase)
+        '''
+        rows = self.rows_of(meter)
+        return np.asarray(self.rows['time_elapsed'][rows.start + 1:rows.stop])
+
+    def first_last(self, meter):
+        '''
+        first and last vending date of meter
+        '''
+        rows = self.rows_of(meter)
+        return self.rows['vending_date'][rows.start], self.rows['vending_date'][rows.stop - 1]
+
+    @property
+    def no_purchase(self):
+        '''
+        number of purchases of each meter
+        '''
+        return np.diff(self.offsets)
+
+    @property
+    def first_vending_date(self):
+        '''
+        first vending date of each meter
+        '''
+        return np.asarray(self.rows['vending_date'][self.offsets[:-1]])
+
+    @property
+    def last_vending_date(self):
+        '''
+        last vending date of each meter
+        '''
+        return np.asarray(self.rows['vending_date'][self.offsets[1:] - 1])
+
+    def meter_table(self):
+        '''
+        one row per meter: county, meterinstdate, first and last vending date and number of purchases
+        '''
+        return pd.DataFrame({'meternumber': np.asarray(self.meters), 'county': np.asarray(self.county), 'meterinstdate': np.asarray(self.meterinstdate),
+                             'first_vending_date': self.first_vending_date, 'last_vending_date': self.last_vending_date, 'no_purchase': self.no_purchase})
@@ -0,0 +1,65 @@
+'''
+normalization of the survey and pre-/postpaid strings before matching
+
+ every column is cleaned in one pass with vectorized .str methods,
+ the patterns are compiled once
+'''
+
+import re
+import numpy as np
+import pandas as pd
+
+# change when the rules below change, cached results are rebuilt (see loader.cached)
+VERSION = 1
+
+SPACES = re.compile(r' +')
+# entries of the number columns that are no numbers: spaces, _ or - and letters
+NOT_NUMBER = re.compile(r'[\s_-]|[aA-zZ]')
+
+NAMES = ['a3_15','a3_22','hh_member1','hh_member2', 'hh_member3', 'hh_member4', 'hh_member5','hh_member6','hh_member7','hh_member8','hh_member9','hh_member10','hh_member11','hh_member12','hh_member13','hh_member14','hh_member15']
+
+
+def clean_text(s, casefold = True, commas = False):
+    '''
+    casefold, replace commas by spaces, remove leading and trailing spaces and duplicated spaces
+    '''
+    if casefold:
+        s = s.str.casefold()
+    if commas:
+        s = s.str.replace(',', ' ', regex=False)
+    return s.str.strip().str.replace(SPACES, ' ', regex=True)
+
+def clean_number(s):
+    '''
+    np.nan for empty entries, '0' and entries with spaces, _, - or letters
+    (np.nan itself as get_match drops entries that are np.nan)
+    '''
+    bad = s.isin(['', '0']) | s.str.contains(NOT_NUMBER, na=False)
+    values = s.to_numpy(dtype=object, copy=True)
+    values[bad.to_numpy()] = np.nan
+    return pd.Series(values, index=s.index, name=s.name)
+
+def normalize_survey(survey, numbers = ['l1_1','l1_2'], names = NAMES):
+    '''
+    meter and account numbers, names of respondent, hh head and members, transno and county
+    '''
+    survey = survey.copy()
+    for c in numbers:
+        survey[c] = clean_number(survey[c])
+    for c in names:
+        survey[c] = clean_text(survey[c])
+    survey['county'] = survey['county'].str.lower()
+    survey['transno'] = clean_text(survey['transno'], commas = True)
+    return survey
+
+def normalize_pp(pp):
+    '''
+    serial and account number, name, transno and county of the pre-/postpaid data
+    '''
+    pp = pp.copy()
+    pp['serial_num'] = pp['serial_num'].str.strip()
+    pp['account_no'] = pp['account_no'].str.strip()
+    pp['county'] = pp['county'].str.lower()
+    pp['full_name'] = clean_text(pp['full_name'])
+    pp['transno'] = clean_text(pp['transno'], commas = True)
+    return pp
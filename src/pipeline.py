@@ -0,0 +1,33 @@
+'''
+command line entry of the pipelines
+
+ python pipeline.py ingest [--sink parquet]          combine consumption.zip (cons_data_processing.py)
+ python pipeline.py analyze [--no-figures]           panels and histograms (cons_data_analysis.py)
+ python pipeline.py merge [--workers 4]              match pre-/postpaid data with the survey (merge.py)
+ python pipeline.py prepost-figures                  figures of the pre-/postpaid data (prepost_figures.py)
+
+ the arguments after the stage go to main() of its module, only that module
+ (and the plotting or matching libraries it needs) is imported
+'''
+
+import sys
+import importlib
+
+# stage -> module
+STAGES = {
+    'ingest': 'cons_data_processing',
+    'analyze': 'cons_data_analysis',
+    'merge': 'merge',
+    'prepost-figures': 'prepost_figures',
+}
+
+def main(argv = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in STAGES:
+        print(__doc__)
+        sys.exit(0 if argv and argv[0] in ['-h', '--help'] else 2)
+    importlib.import_module(STAGES[argv[0]]).main(argv[1:])
+
+
+if __name__ == '__main__':
+    main()
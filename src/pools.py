@@ -0,0 +1,16 @@
+'''
+start method of the process pools of the scripts
+'''
+
+import sys
+import multiprocessing
+
+def mp_context():
+    '''
+    context for ProcessPoolExecutor(mp_context = ...): fork on Linux, starts faster than spawn and the
+    workers get the loaded data without pickling; the platform default elsewhere (spawn on macOS, where
+    fork is not safe, and Windows), the scripts are guarded by __main__ for spawn
+    '''
+    if sys.platform.startswith('linux'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
@@ -1,124 +1,213 @@
+'''
+figures of the post- and prepaid data: calendar, time series and monthly usage
+
+ the figures are drawn from two small aggregates cached in data/cache: the monthly cube
+ (meter x month x service) and the daily series (date x service), re-rendering the
+ figures does not load the transactions again
+
+ python prepost_figures.py [--data ../data] [--figures ../figures/post_pre_paid]
+ or from python: prepost_figures.run(data, figures)
+'''
+
+import argparse
 from pathlib import Path
 import pandas as pd
-from zipfile import ZipFile
-import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
+from loader import read_member, member_key, cached
+from schema import PREPOST, concat
+from instrument import stage, write_report
+from transactions import collapse
 
 wd = Path.cwd()
 folder = 'data'
 path_figure = wd.parent/'figures'/'post_pre_paid'
-
-# load data
-zipf = ZipFile(wd.parent/folder/'post_pre_paid.zip')
-post = pd.read_csv(zipf.open('Postpaid_AFDB_TX_Data_20220126.txt'),sep = '|')
-pre = pd.read_csv(zipf.open('Prepaid_AFDB_TX_Data_20220126.txt'), sep = '|')
-pp = post.append(pre).reset_index(drop=True)
-
-pp.columns = pp.columns.str.lower()
-
-
-pp.loc[pp['billing_date'].isnull(),'billing_date'] = pp.loc[pp['billing_date'].isnull(),'date_of_vend']
-pp = pp.drop('date_of_vend',axis=1)
-pp['billing_date'] = pd.to_datetime(pp['billing_date'])
-
-pp.loc[pp['id_bill'].isnull(),'id_bill'] = pp.loc[pp['id_bill'].isnull(),'receipt_no']
-pp = pp.drop('receipt_no',axis=1)
-
-# add rows if same meternumber and vending_date
-id_cols = ['serial_num', 'billing_date']
-collapse = pp.groupby(id_cols)[['amount', 'units', 'collected']].sum()
-collapse.reset_index(inplace = True)
-
-pp = pp.drop(columns=['amount', 'units', 'collected'])
-df = pp.merge(collapse, how='left').drop_duplicates(id_cols)
-
-# sort df by meternumber and vending date
-df = df.sort_values(by = id_cols)
-
-# time elapsed between purchases 
-df['time_elapsed'] = df['billing_date'].diff() 
-df.loc[(df['serial_num'] != df['serial_num'].shift(1)) ,'time_elapsed'] = np.nan
-
-# get year
-df['year'] = df['billing_date'].dt.year
-
-# yearmonth
-df['month'] = df['billing_date'].dt.month
-
-df['yearmonth'] = df['year'].astype(str) + '/' + df['month'].astype(str) 
-
-# get weekday
-weekdays= ['Monday','Tuesday','Wednesday','Thursday','Friday','Saturday','Sunday']
-df['dayofweek'] = pd.Categorical(df['billing_date'].dt.day_name(), categories=weekdays, ordered=True)
-
-
-# get day of month
-df['dayofmonth'] = df['billing_date'].dt.day
-
-
-# first vending date per meter
-first_vend = df.groupby(['serial_num'])['billing_date'].min().reset_index().rename(columns = {'billing_date':'first_billing_date'})
-df = df.merge(first_vend, on=['serial_num'], how = 'left')
+members = ['Postpaid_AFDB_TX_Data_20220126.txt', 'Prepaid_AFDB_TX_Data_20220126.txt']
+# version of prepare() and the aggregates, change it to rebuild the cached aggregates
+VERSION = 1
+
+########################
+# FUNCTIONS
+#######################
+
+def load(data):
+    '''
+    post- and prepaid data in the folder data, lower case column names
+    '''
+    with stage('load') as st:
+        pp = concat([read_member(data/'post_pre_paid.zip', m, schema = PREPOST, sep = '|') for m in members]).reset_index(drop=True)
+        st.rows_out = len(pp)
+
+    pp.columns = pp.columns.str.lower()
+    return pp
+
+def prepare(pp):
+    '''
+    one row per meter and billing date, the columns of monthly_cube and daily_series
+    '''
+    with stage('prepare', rows_in = len(pp)) as st:
+        pp.loc[pp['billing_date'].isnull(),'billing_date'] = pp.loc[pp['billing_date'].isnull(),'date_of_vend']
+        pp = pp.drop('date_of_vend',axis=1)
+        pp['billing_date'] = pd.to_datetime(pp['billing_date'])
+
+        pp.loc[pp['id_bill'].isnull(),'id_bill'] = pp.loc[pp['id_bill'].isnull(),'receipt_no']
+        pp = pp.drop('receipt_no',axis=1)
+
+        # add rows if same meternumber and vending_date, sorted by meternumber and vending date
+        id_cols = ['serial_num', 'billing_date']
+        df = collapse(pp, id_cols, ['amount', 'units', 'collected'])
+        st.rows_out = len(df)
+    return df
+
+
+########################
+# AGGREGATES
+#######################
+
+def monthly_cube(df):
+    '''
+    units, amount and number of purchases per meter, calendar month and service
+    month: integer period key year*12 + month - 1
+    '''
+    with stage('monthly cube', rows_in = len(df)) as st:
+        month = (df['billing_date'].dt.year*12 + df['billing_date'].dt.month - 1).rename('month')
+        cube = df.groupby(['serial_num', month, 'offered_service'], observed=True).agg(units = ('units', 'sum'), amount = ('amount', 'sum'), purchases = ('units', 'size')).reset_index()
+        cube['month'] = cube['month'].astype('int32')
+        st.rows_out = len(cube)
+    return cube
+
+def daily_series(df):
+    '''
+    units, amount and number of purchases per billing date and service
+    '''
+    with stage('daily series', rows_in = len(df)) as st:
+        daily = df.groupby(['billing_date','offered_service'], observed=True).agg(amount = ('amount', 'sum'), units = ('units', 'sum'), purchases = ('units', 'size')).reset_index()
+        st.rows_out = len(daily)
+    return daily
+
+def aggregates(data):
+    '''
+    monthly cube and daily series of the post- and prepaid data in the folder data
+    both are stored in data/cache and only built again if the data (or VERSION) changes
+    '''
+    key = ([member_key(data/'post_pre_paid.zip', m) for m in members], VERSION)
+    prepared = []
+    def df():
+        # load and prepare the data once for both tables, and only if one is not in the cache
+        if not prepared:
+            prepared.append(prepare(load(data)))
+        return prepared[0]
+    cube = cached('prepost_monthly', key, lambda: monthly_cube(df()), data/'cache')
+    daily = cached('prepost_daily', key, lambda: daily_series(df()), data/'cache')
+    return cube, daily
 
 
 ############# figures ##############
 
-# day of week histogram
-categories = df['dayofweek'].value_counts(sort=False).index
-counts = df['dayofweek'].value_counts(sort=False,normalize=True).values
-fig, ax = plt.subplots(tight_layout=True)
-ax.bar(categories, counts, width=0.5)
-fig.savefig(path_figure/'dayofweek.png')
-
-# day of month histogram
-categories = df['dayofmonth'].value_counts().sort_index().index
-counts = df['dayofmonth'].value_counts(normalize=True).sort_index().values
-fig, ax = plt.subplots(tight_layout=True)
-ax.bar(categories, counts, width=0.5)
-fig.savefig(path_figure/'dayofmonth.png')
-
-# time series
-ts = df.groupby(['billing_date','offered_service'])[['amount','units']].sum().reset_index()
-ts['offered_service'] = pd.Categorical(ts['offered_service'])
-colors = {'POSTPAID':'blue', 'PREPAID':'orange'}
-
-offser = ['POSTPAID','PREPAID']
-for os in offser:
-    data = ts[ts.offered_service ==os]
-    fig, ax =plt.subplots()
-    ax.set_ylabel('units', color = 'red') 
-    ax.plot(data.billing_date,data.units, color='red', alpha=.6)
-    ax2 =ax.twinx()
-    ax2.set_ylabel('amount', color = 'blue') 
-    ax2.plot(data.billing_date,data.amount, color='blue', alpha=.6)
-    plt.title(f'{os}')
-    fig.savefig(path_figure/f'ts_{os}.png')
-
-# histogram monthly usage
-
-yearmonth = df.groupby(['serial_num','yearmonth','offered_service'])['units'].sum().reset_index()
-
-yearmonth = yearmonth.groupby(['serial_num','offered_service'])['units'].mean().rename('units_monthly_mean').reset_index()
-
-
-postpaid = yearmonth.offered_service == 'POSTPAID'
-post975 = yearmonth.units_monthly_mean[postpaid] < yearmonth.units_monthly_mean[postpaid].quantile(.975)
-post025 = yearmonth.units_monthly_mean[postpaid] > yearmonth.units_monthly_mean[postpaid].quantile(.025)
-
-prepaid = yearmonth.offered_service == 'PREPAID'
-pre975 = yearmonth.units_monthly_mean[prepaid] < yearmonth.units_monthly_mean[prepaid].quantile(.975)
-pre025 = yearmonth.units_monthly_mean[prepaid] > yearmonth.units_monthly_mean[prepaid].quantile(.025)
-
-
-fig, ax = plt.subplots()
-colors = {'POSTPAID':'blue','PREPAID':'red'}
-for p in ['POSTPAID','PREPAID']:
-    ppaid = yearmonth.offered_service == p
-    data = yearmonth.units_monthly_mean[ppaid]
-    p975 = data < data.quantile(.975)
-    p025 = data > data.quantile(.025)
-    sns.histplot(x = data[p975 & p025], ax=ax, stat='percent', kde=True, alpha=.4, label = p + ' 95%', color=colors[p])
-ax.set_xlabel('average monthy usage per meter')
-plt.legend()
-fig.savefig(path_figure/f'hist_usage.png')
+def calendar_figures(daily, path_figure):
+    '''
+    share of purchases by day of week and day of month
+    '''
+    import matplotlib.pyplot as plt
+
+    with stage('calendar figures'):
+        purchases = daily.groupby('billing_date')['purchases'].sum()
+        # day of week histogram
+        weekdays= ['Monday','Tuesday','Wednesday','Thursday','Friday','Saturday','Sunday']
+        dayofweek = purchases.groupby(purchases.index.dayofweek).sum().reindex(range(7), fill_value = 0)
+        categories = pd.CategoricalIndex(weekdays, categories=weekdays, ordered=True)
+        counts = (dayofweek/dayofweek.sum()).values
+        fig, ax = plt.subplots(tight_layout=True)
+        ax.bar(categories, counts, width=0.5)
+        fig.savefig(path_figure/'dayofweek.png')
+
+        # day of month histogram
+        dayofmonth = purchases.groupby(purchases.index.day).sum()
+        categories = dayofmonth.index
+        counts = (dayofmonth/dayofmonth.sum()).values
+        fig, ax = plt.subplots(tight_layout=True)
+        ax.bar(categories, counts, width=0.5)
+        fig.savefig(path_figure/'dayofmonth.png')
+
+def time_series(daily, path_figure):
+    '''
+    daily units and amount of post- and prepaid
+    '''
+    import matplotlib.pyplot as plt
+
+    # time series
+    with stage('time series'):
+        ts = daily[['billing_date','offered_service','amount','units']].copy()
+        ts['offered_service'] = pd.Categorical(ts['offered_service'])
+        colors = {'POSTPAID':'blue', 'PREPAID':'orange'}
+
+        offser = ['POSTPAID','PREPAID']
+        for os in offser:
+            data = ts[ts.offered_service ==os]
+            fig, ax =plt.subplots()
+            ax.set_ylabel('units', color = 'red')
+            ax.plot(data.billing_date,data.units, color='red', alpha=.6)
+            ax2 =ax.twinx()
+            ax2.set_ylabel('amount', color = 'blue')
+            ax2.plot(data.billing_date,data.amount, color='blue', alpha=.6)
+            plt.title(f'{os}')
+            fig.savefig(path_figure/f'ts_{os}.png')
+
+def trimmed(values, by, low = .025, high = .975):
+    '''
+    True for the values strictly between the low and high quantile of their group in by
+    '''
+    bounds = values.groupby(by, observed=True).quantile([low, high]).unstack()
+    return (values > by.map(bounds[low]).astype(float)) & (values < by.map(bounds[high]).astype(float))
+
+def monthly_usage(cube, path_figure):
+    '''
+    histogram of the average monthly units per meter, post- and prepaid without the top and bottom 2.5%
+    '''
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    # histogram monthly usage
+
+    with stage('monthly usage'):
+        yearmonth = cube.groupby(['serial_num','offered_service'], observed=True)['units'].mean().rename('units_monthly_mean').reset_index()
+        keep = trimmed(yearmonth['units_monthly_mean'], yearmonth['offered_service'])
+
+        fig, ax = plt.subplots()
+        colors = {'POSTPAID':'blue','PREPAID':'red'}
+        for p in ['POSTPAID','PREPAID']:
+            ppaid = yearmonth.offered_service == p
+            data = yearmonth.units_monthly_mean[ppaid]
+            sns.histplot(x = data[keep[ppaid]], ax=ax, stat='percent', kde=True, alpha=.4, label = p + ' 95%', color=colors[p])
+        ax.set_xlabel('average monthy usage per meter')
+        plt.legend()
+        fig.savefig(path_figure/f'hist_usage.png')
+
+########################
+# RUN
+#######################
+
+def run(data = wd.parent/folder, path_figure = path_figure):
+    '''
+    figures of the post- and prepaid data in the folder data, saved in the folder path_figure
+    the data is only loaded if the aggregates are not in data/cache (see aggregates)
+    returns the monthly cube and the daily series
+    '''
+    data, path_figure = Path(data), Path(path_figure)
+    cube, daily = aggregates(data)
+    calendar_figures(daily, path_figure)
+    time_series(daily, path_figure)
+    monthly_usage(cube, path_figure)
+
+    # timings of the stages, if LMCP_PROFILE is set (see instrument.py)
+    write_report(data/'profile_prepost_figures.json')
+    return cube, daily
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='figures of the post- and prepaid data')
+    parser.add_argument('--data', default=wd.parent/folder, type=Path, help='folder with post_pre_paid.zip (default: ../data)')
+    parser.add_argument('--figures', default=path_figure, type=Path, help='folder of the figures (default: ../figures/post_pre_paid)')
+    args = parser.parse_args(argv)
+    run(args.data, args.figures)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+'''
+dtypes of the transaction data
+
+ text with few distinct values and the meter keys are stored as category
+ (dictionary-encoded, categories sorted like the strings), numbers are
+ downcast where no value changes
+ -> group by category columns with observed=True
+'''
+
+import numpy as np
+import pandas as pd
+
+# consumption data (consumption.zip, cons_data_all)
+CONSUMPTION = {'county':'category', 'zrefrence':'category', 'name':'category', 'incms_name':'category', 'meternumber':'category',
+               'amount':'numeric', 'units':'numeric', 'debt_collected':'numeric'}
+
+# pre- and postpaid data, column names as in the raw files
+PREPOST = {'COUNTY':'category', 'TRANSNO':'category', 'OFFERED_SERVICE':'category', 'SERIAL_NUM':'category', 'ACCOUNT_NO':'category',
+           'AMOUNT':'numeric', 'UNITS':'numeric', 'COLLECTED':'numeric'}
+
+
+def downcast(s):
+    '''
+    float64 -> float32 and int64 -> int32 if all values stay the same
+    '''
+    if s.dtype == np.float64:
+        small = s.astype(np.float32)
+    elif s.dtype == np.int64:
+        small = s.astype(np.int32)
+    else:
+        return s
+    if ((small == s) | s.isnull()).all():
+        return small
+    return s
+
+def apply_schema(df, schema):
+    '''
+    convert the columns of df that appear in schema (in place), returns df
+    '''
+    for c, dtype in schema.items():
+        if c not in df.columns:
+            continue
+        if dtype == 'numeric':
+            df[c] = downcast(df[c])
+        else:
+            df[c] = df[c].astype(dtype)
+    return df
+
+def concat(frames):
+    '''
+    pd.concat that keeps category columns, their categories are combined (sorted)
+    '''
+    frames = list(frames)
+    for c in frames[0].columns:
+        if all((c in f.columns) and isinstance(f[c].dtype, pd.CategoricalDtype) for f in frames):
+            categories = frames[0][c].cat.categories
+            for f in frames[1:]:
+                categories = categories.union(f[c].cat.categories)
+            frames = [f.assign(**{c: f[c].cat.set_categories(categories)}) for f in frames]
+    return pd.concat(frames)
@@ -0,0 +1,201 @@
+'''
+streaming summary statistics that can be merged across chunks and workers
+
+ KLL         quantile sketch (Karnin, Lang, Liberty 2016): a few hundred values stand for
+             any number of values, the rank error is about 1.7/k of the count; with fewer
+             values than fit in the sketch the quantiles are exact (linear interpolation
+             like np.quantile)
+ Histogram   counts in fixed bins of width binwidth, the range grows with the data; with
+             integer data and binwidth = 1 these are the exact value counts and histogram()
+             gives the same result as np.histogram on the data for bins on integers
+
+ both are filled chunk by chunk with update() and combined with merge(), e.g.
+
+ h = Histogram(1)
+ for chunk in chunks:
+     h.update(chunk['days'])
+ values, edges = h.histogram(bins = range(0, 100, 5), density = True)
+'''
+
+import numpy as np
+
+########################
+# FUNCTIONS
+#######################
+
+def finite(values, weights = None):
+    '''
+    values (and weights) as float arrays without missing values
+    '''
+    values = np.asarray(values, dtype = np.float64).ravel()
+    keep = ~np.isnan(values)
+    if weights is None:
+        return values[keep], None
+    return values[keep], np.asarray(weights, dtype = np.float64).ravel()[keep]
+
+class KLL:
+    '''
+    quantile sketch of a stream of numbers
+    k: size of the largest compactor, more is more accurate
+    '''
+    def __init__(self, k = 200, seed = None):
+        self.k = k
+        self.rng = np.random.default_rng(seed)
+        # compactors: the values of level h stand for 2**h values each
+        self.levels = [np.empty(0)]
+        self.n = 0
+        self.min, self.max = np.inf, -np.inf
+
+    def capacity(self, h):
+        '''
+        number of values level h holds before it is compacted, smaller for the lower levels
+        '''
+        return max(2, int(np.ceil(self.k*(2/3)**(len(self.levels) - 1 - h))))
+
+    def update(self, values):
+        '''
+        add the values of an array (missing values are ignored)
+        '''
+        values, _ = finite(values)
+        if len(values) == 0:
+            return self
+        self.n += len(values)
+        self.min, self.max = min(self.min, values.min()), max(self.max, values.max())
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+        return self
+
+    def compress(self):
+        '''
+        compact the levels over their capacity: sort, keep every second value (random start) for the next level
+        '''
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if len(level) > self.capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                level = np.sort(level)
+                # an odd value stays at this level
+                rest, level = (level[-1:], level[:-1]) if len(level) % 2 else (level[:0], level)
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], level[self.rng.integers(2)::2]])
+                self.levels[h] = rest
+                # the capacities of the lower levels shrink when a level is added, check them again
+                h = 0
+            else:
+                h += 1
+
+    def merge(self, other):
+        '''
+        add the values of another sketch
+        '''
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, level in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], level])
+        self.n += other.n
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        self.compress()
+        return self
+
+    def values(self):
+        '''
+        values in the sketch, sorted, and the number of values each stands for
+        '''
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2.0**h) for h, level in enumerate(self.levels)])
+        order = np.argsort(values, kind = 'mergesort')
+        return values[order], weights[order]
+
+    def quantile(self, q):
+        '''
+        quantile(s) q in [0, 1], linear interpolation between the ranks like np.quantile, nan if empty
+        '''
+        q = np.asarray(q, dtype = np.float64)
+        if self.n == 0:
+            return np.full(q.shape, np.nan) if q.ndim else np.nan
+        values, weights = self.values()
+        # the values stand for the ranks up to their cumulative weight, scaled to the count
+        upper = np.cumsum(weights)*self.n/weights.sum()
+        rank = q*(self.n - 1)
+        lo, hi = np.floor(rank), np.ceil(rank)
+        at = lambda r: values[np.minimum(np.searchsorted(upper, r, side = 'right'), len(values) - 1)]
+        out = at(lo) + (rank - lo)*(at(hi) - at(lo))
+        # the extremes are known exactly
+        out = np.where(q <= 0, self.min, np.where(q >= 1, self.max, out))
+        return out if q.ndim else float(out)
+
+    def median(self):
+        return self.quantile(.5)
+
+class Histogram:
+    '''
+    counts in bins [origin + i*binwidth, origin + (i+1)*binwidth), the range grows with the data
+    '''
+    def __init__(self, binwidth = 1, origin = 0):
+        self.binwidth, self.origin = binwidth, origin
+        # counts[i] is the bin start + i
+        self.start = 0
+        self.counts = np.zeros(0)
+        self.n = 0
+        self.min, self.max = np.inf, -np.inf
+
+    def grow(self, lo, hi):
+        '''
+        extend counts to the bins lo to hi (inclusive)
+        '''
+        if len(self.counts) == 0:
+            self.start, self.counts = lo, np.zeros(hi - lo + 1)
+            return
+        new_start, new_end = min(self.start, lo), max(self.start + len(self.counts) - 1, hi)
+        if (new_start, new_end) != (self.start, self.start + len(self.counts) - 1):
+            counts = np.zeros(new_end - new_start + 1)
+            counts[self.start - new_start:self.start - new_start + len(self.counts)] = self.counts
+            self.start, self.counts = new_start, counts
+
+    def update(self, values, weights = None):
+        '''
+        add the values of an array, each with its weight (default 1), missing values are ignored
+        '''
+        values, weights = finite(values, weights)
+        if len(values) == 0:
+            return self
+        bins = np.floor((values - self.origin)/self.binwidth).astype(np.int64)
+        lo, hi = int(bins.min()), int(bins.max())
+        self.grow(lo, hi)
+        self.counts += np.bincount(bins - self.start, weights = weights, minlength = len(self.counts))
+        self.n += len(values) if weights is None else weights.sum()
+        self.min, self.max = min(self.min, values.min()), max(self.max, values.max())
+        return self
+
+    def merge(self, other):
+        '''
+        add the counts of another histogram with the same bins
+        '''
+        if (self.binwidth, self.origin) != (other.binwidth, other.origin):
+            raise ValueError('histograms with different bins cannot be merged')
+        if len(other.counts):
+            self.grow(other.start, other.start + len(other.counts) - 1)
+            self.counts[other.start - self.start:other.start - self.start + len(other.counts)] += other.counts
+        self.n += other.n
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        return self
+
+    def edges(self):
+        '''
+        edges of the bins of counts
+        '''
+        return self.origin + self.binwidth*np.arange(self.start, self.start + len(self.counts) + 1)
+
+    def histogram(self, bins = None, density = False):
+        '''
+        (values, edges) like np.histogram: the own bins, or the counts put into bins (integer number or edges)
+        exact if the edges of bins are edges of this histogram
+        '''
+        if bins is None:
+            values = self.counts/(self.counts.sum()*self.binwidth) if density else self.counts.copy()
+            return values, self.edges()
+        # each bin counts at its left edge, an integer number of bins spans the left edges (the minimum and maximum for integers)
+        lefts = self.edges()[:-1]
+        span = (lefts[0], lefts[-1]) if len(lefts) else None
+        return np.histogram(lefts, bins = bins, range = span, weights = self.counts, density = density)
@@ -0,0 +1,164 @@
+'''
+synthetic data with the layout of the files in data, for tests and benchmarks without the confidential extracts
+
+ survey.zip: households in transformer blocks (transno), names of respondent, hh head and members,
+  meter and account numbers with the usual junk entries ('', '0', letters)
+ post_pre_paid.zip: transactions of customers of the surveyed blocks, names misspelled,
+  serial and account numbers with typos, some records in another transno
+ consumption.zip: several members with the same columns, one with other columns (skipped)
+  and the Kilifi file with its own column names
+
+ python synthetic.py ../bench --households 2000 --meters 5000
+'''
+
+import io
+import argparse
+import numpy as np
+import pandas as pd
+from zipfile import ZipFile, ZIP_DEFLATED
+from pathlib import Path
+
+first_names = ['john','mary','peter','jane','otieno','wanjiru','kamau','achieng','mwangi','njeri','ouma','akinyi','wafula','nafula','kiprono','chebet','mutua','mwikali','juma','halima']
+counties = ['BUSIA','SIAYA','KAKAMEGA','MIGORI']
+
+########################
+# FUNCTIONS
+#######################
+
+def digits(rng, n, k):
+    '''
+    n random strings of k digits
+    '''
+    return [''.join(map(str, d)) for d in rng.integers(0, 10, (n, k))]
+
+def names(rng, n, words = 2):
+    '''
+    n random names of words first names
+    '''
+    return [' '.join(w) for w in rng.choice(first_names, (n, words))]
+
+def noisy(rng, strings, edits = 2):
+    '''
+    replace up to edits characters of each string by a random digit or letter
+    '''
+    out = []
+    for s in strings:
+        s = list(s)
+        for _ in range(rng.integers(0, edits + 1)):
+            if len(s) > 0:
+                s[rng.integers(len(s))] = rng.choice(list('0123456789abcdefgh'))
+        out.append(''.join(s))
+    return out
+
+def make_survey(rng, households, transformers):
+    '''
+    survey with households in transformers blocks, columns as in workingsample8.dta
+    '''
+    trans = np.array([f'{40000 + i} Market {i}' for i in range(transformers)])
+    block = rng.integers(0, transformers, households)
+    serial = np.array(digits(rng, households, 11), dtype=object)
+    account = np.array(digits(rng, households, 8), dtype=object)
+    survey = pd.DataFrame({'county': np.array(counties)[block % len(counties)], 'transno': trans[block], 'transname': 'x',
+                           'a1_7': [f'HH_{i}' for i in rng.integers(1, 60, households)],
+                           'a3_15': [n.title() + '  ' for n in names(rng, households)], 'a3_22': names(rng, households)})
+    for k in range(1, 16):
+        survey[f'hh_member{k}'] = np.where(rng.random(households) < 0.3, names(rng, households), '')
+    # junk entries in the number columns, transno written with commas
+    survey['l1_1'] = np.where(rng.random(households) < 0.7, serial, rng.choice(['', '0', 'no meter'], households))
+    survey['l1_2'] = np.where(rng.random(households) < 0.6, account, rng.choice(['', '-'], households))
+    survey['lmcp'] = rng.integers(0, 2, households)
+    commas = rng.random(households) < 0.2
+    survey.loc[commas, 'transno'] = ' ' + survey.loc[commas, 'transno'].str.replace(' ', ',  ')
+    return survey, serial, account
+
+def make_prepost(rng, survey, serial, account, customers, purchases = 6):
+    '''
+    post- and prepaid transactions (two dataframes) of customers drawn from the survey households
+    '''
+    hh = rng.integers(0, len(survey), customers)
+    trans = survey['transno'].str.strip().str.replace(',  ', ' ', regex=False).to_numpy()
+    n = rng.integers(1, purchases + 1, customers)
+    c = np.repeat(np.arange(customers), n)
+    h = hh[c]
+    rows = len(c)
+    post = rng.random(customers)[c] < 0.5
+    date = (pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(0, 900, rows), 'D')).strftime('%Y-%m-%d')
+    # noise per customer, repeated for each transaction
+    full_name = np.array(noisy(rng, survey['a3_15'].str.upper().to_numpy()[hh]), dtype=object)[c]
+    serial_num = np.array(noisy(rng, serial[hh]), dtype=object)[c]
+    account_no = np.array(noisy(rng, account[hh]), dtype=object)[c]
+    moved = rng.random(customers)[c] < 0.05
+    pp = pd.DataFrame({'COUNTY': survey['county'].to_numpy()[h], 'TXNUMBER': rng.integers(1, 10, rows),
+                       'TRANSNO': np.where(moved, rng.choice(trans, rows), trans[h]), 'FULL_NAME': full_name,
+                       'SERIAL_NUM': np.where(rng.random(rows) < 0.1, ' ' + serial_num, serial_num), 'ACCOUNT_NO': account_no,
+                       'OFFERED_SERVICE': np.where(post, 'POSTPAID', 'PREPAID'),
+                       'BILLING_DATE': np.where(post, date, None), 'DATE_OF_VEND': np.where(post, None, date),
+                       'ID_BILL': np.where(post, rng.integers(1, 10**6, rows), np.nan), 'RECEIPT_NO': np.where(post, np.nan, rng.integers(1, 10**6, rows)),
+                       'AMOUNT': rng.integers(10, 900, rows).astype(float), 'UNITS': rng.random(rows).round(2)*50, 'COLLECTED': rng.integers(0, 20, rows).astype(float)})
+    return pp[post].reset_index(drop=True), pp[~post].reset_index(drop=True)
+
+def make_consumption(rng, meters, purchases = 40, members = 4):
+    '''
+    consumption data: list of (member name, dataframe) with '|' separated layout, incl. the Kilifi file
+    '''
+    meter = np.array(digits(rng, meters, 11))
+    inst = pd.Timestamp('2016-01-01') + pd.to_timedelta(rng.integers(0, 1800, meters), 'D')
+    county = rng.choice(counties, meters)
+    n = rng.integers(1, 2*purchases, meters)
+    m = np.repeat(np.arange(meters), n)
+    vending = inst[m] + pd.to_timedelta(rng.integers(-20, 900, len(m)), 'D')
+    df = pd.DataFrame({'county': county[m], 'zrefrence': rng.integers(10**5, 10**6, meters)[m].astype(str), 'name': 'Xx', 'meternumber': meter[m], 'incms_name': 'Xx',
+                       'meterinstdate': inst[m].strftime('%Y-%m-%d'), 'vending_date': vending.strftime('%Y-%m-%d'),
+                       'amount': rng.integers(10, 500, len(m)).astype(float), 'units': rng.random(len(m))*10, 'debt_collected': rng.integers(0, 50, len(m))})
+    # meters are split among the members, the last part goes to the Kilifi file
+    part = np.minimum(np.arange(meters)*(members + 1)//meters, members)[m]
+    files = [(f'consumption/consumption_{i}.txt', df[part == i]) for i in range(members)]
+    # same number of columns, other names
+    files.append(('consumption/other_layout.txt', df[part == 0].rename(columns={'name':'customer_name'}).head(100)))
+    kilifi = df[part == members].assign(county='KILIFI', vending_date=vending[part == members].strftime('%Y-%m-%d %H:%M'))
+    kilifi = kilifi.rename(columns={'county':'COUNTY', 'zrefrence':'REFERENCE_', 'name':'CUSTOMERNAME', 'meternumber':'METER', 'incms_name':'INCMS_CUSTOMER_NAME', 'meterinstdate':'CONNECTION_DATE',
+                                    'vending_date':'PURCHASE_DATE', 'amount':'AMOUNT_KES', 'units':'UNITS_KWH', 'debt_collected':'AMOUNT_LCMP_LOAN'})
+    kilifi.loc[kilifi.sample(frac=0.01, random_state=0).index, 'AMOUNT_KES'] = np.nan
+    files.append(('consumption/Kilifi_data_20210308.txt', kilifi[['COUNTY','REFERENCE_','CUSTOMERNAME','METER','INCMS_CUSTOMER_NAME','CONNECTION_DATE','PURCHASE_DATE','AMOUNT_KES','UNITS_KWH','AMOUNT_LCMP_LOAN']]))
+    return files
+
+def write_data(root, households = 2000, transformers = 50, customers = None, meters = 5000, seed = 0):
+    '''
+    write data/survey.zip, data/post_pre_paid.zip and data/consumption.zip in root, and the figure folders
+    customers: number of pre-/postpaid customers, defaults to 2 x households
+    returns the number of rows written per file
+    '''
+    rng = np.random.default_rng(seed)
+    root = Path(root)
+    (root/'data').mkdir(parents=True, exist_ok=True)
+    (root/'figures'/'post_pre_paid').mkdir(parents=True, exist_ok=True)
+
+    survey, serial, account = make_survey(rng, households, transformers)
+    buffer = io.BytesIO()
+    survey.to_stata(buffer, write_index=False)
+    with ZipFile(root/'data'/'survey.zip', 'w', compression=ZIP_DEFLATED) as zip:
+        zip.writestr('survey/workingsample8.dta', buffer.getvalue())
+
+    post, pre = make_prepost(rng, survey, serial, account, 2*households if customers is None else customers)
+    with ZipFile(root/'data'/'post_pre_paid.zip', 'w', compression=ZIP_DEFLATED) as zip:
+        zip.writestr('Postpaid_AFDB_TX_Data_20220126.txt', post.to_csv(sep='|', index=False))
+        zip.writestr('Prepaid_AFDB_TX_Data_20220126.txt', pre.to_csv(sep='|', index=False))
+
+    files = make_consumption(rng, meters)
+    with ZipFile(root/'data'/'consumption.zip', 'w', compression=ZIP_DEFLATED) as zip:
+        for name, df in files:
+            zip.writestr(name, df.to_csv(sep='|', index=False))
+
+    return {'survey': len(survey), 'post_pre_paid': len(post) + len(pre), 'consumption': sum(len(df) for name, df in files if 'other_layout' not in name)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='write synthetic data to ROOT/data')
+    parser.add_argument('root')
+    parser.add_argument('--households', type=int, default=2000)
+    parser.add_argument('--transformers', type=int, default=50)
+    parser.add_argument('--customers', type=int, default=None)
+    parser.add_argument('--meters', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(write_data(args.root, args.households, args.transformers, args.customers, args.meters, args.seed))
@@ -0,0 +1,40 @@
+'''
+operations on the transaction data shared by the scripts
+
+ collapse: purchases of the same meter on the same day -> one row
+'''
+
+import numpy as np
+import pandas as pd
+
+########################
+# FUNCTIONS
+#######################
+
+def collapse(df, keys, measures):
+    '''
+    one row per value of keys, sorted by keys: the sum of measures and the other columns of the first row
+    same as summing measures per keys, merging the sums back and dropping duplicates of keys, in one grouping
+    the rows keep the index of their first row
+    keys: e.g. ['meternumber', 'vending_date']
+    measures: columns that are added, e.g. ['amount', 'units', 'debt_collected']
+    '''
+    # groups in the order of their first row
+    g = df.groupby(keys, observed = True, sort = False)
+    sums = g[measures].sum()
+    # position of the first row of each group (rows with a missing key are in no group)
+    codes = g.ngroup()
+    rows = np.flatnonzero(codes.notna().to_numpy())[::-1]
+    first = np.empty(len(sums), dtype = np.int64)
+    first[codes.to_numpy()[rows].astype(np.int64)] = rows
+    # sort the groups by their keys before taking the rows, the frame itself is never sorted
+    order = df[keys].iloc[first].reset_index(drop = True).sort_values(keys).index.to_numpy()
+    attributes = [i for i, c in enumerate(df.columns) if c not in measures]
+    out = df.iloc[first[order], attributes]
+    for m in measures:
+        out[m] = sums[m].to_numpy()[order]
+    # rows with a missing key have no sums, the first of each is kept
+    missing = df[keys].isna().any(axis = 1)
+    if missing.any():
+        out = pd.concat([out, df.loc[missing].drop_duplicates(keys).assign(**{m: np.nan for m in measures})]).sort_values(keys)
+    return out